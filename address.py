@@ -0,0 +1,22 @@
+import socket
+
+
+# addresses are stored the way MySQL's INET6_ATON() lays them out: 4 bytes for IPv4 and 16 bytes for IPv6, in
+# network byte order, so INET6_NTOA() can be used to read them back
+
+
+def pack_address(address):
+    try:
+        return socket.inet_pton(socket.AF_INET, address)
+    except OSError:
+        pass
+    try:
+        return socket.inet_pton(socket.AF_INET6, address)
+    except OSError:
+        return None
+
+
+def unpack_address(packed):
+    if len(packed) == 4:
+        return socket.inet_ntop(socket.AF_INET, packed)
+    return socket.inet_ntop(socket.AF_INET6, packed)
@@ -0,0 +1,306 @@
+import array
+import functools
+import heapq
+import itertools
+import operator
+import os
+import struct
+import tempfile
+import time
+
+# packed records are the number of records and key columns followed by sections, each an array typecode (- for
+# raw bytes) and a byte length: the counts, first and last timestamps, then each key column marked i for ints,
+# b or s for bytes or str values, or B or S for distinct bytes or str values with an index per record
+_HEADER = struct.Struct("<IB")
+_SECTION = struct.Struct("<cQ")
+# spill runs are blocks of packed records, each preceded by its length
+_BLOCK = struct.Struct("<Q")
+
+
+@functools.lru_cache(maxsize=1024)
+def day_string(day):
+    # days since the epoch as the UTC date the rollup tables are keyed on
+    return time.strftime("%Y-%m-%d", time.gmtime(day * 86400))
+
+
+class Aggregator(object):
+    # collects the number of times each key was seen along with the earliest and latest timestamp
+    # so that a log file turns into one database upsert per distinct key.  with daily set the counts
+    # are kept per UTC day as well, for the rollup tables.  records may be spilled to sorted runs on disk
+    # to bound memory, and are then read back merged with the ones still in memory
+    def __init__(self, fields, daily=False, spill_dir=None):
+        self.fields = fields
+        self.daily = daily
+        self.spill_dir = spill_dir
+        self.records = {}
+        # (path, number of records) of each run spilled since the last take()
+        self.runs = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, key, ts, count=1):
+        if self.daily:
+            key = key + (int(ts // 86400),)
+        record = self.records.get(key)
+        if record is None:
+            self.records[key] = [count, ts, ts]
+            return
+        record[0] += count
+        if ts < record[1]:
+            record[1] = ts
+        elif ts > record[2]:
+            record[2] = ts
+
+    def _add(self, key, count, first, last):
+        record = self.records.get(key)
+        if record is None:
+            self.records[key] = [count, first, last]
+            return
+        record[0] += count
+        if first < record[1]:
+            record[1] = first
+        if last > record[2]:
+            record[2] = last
+
+    def merge(self, records):
+        # folds in the records of another aggregator, e.g. partial counts from a worker process
+        for key, (count, first, last) in records.items():
+            self._add(key, count, first, last)
+
+    def merge_packed(self, data):
+        # folds in records packed by pack(), straight from a buffer such as shared memory
+        for key, count, first, last in unpack(data):
+            self._add(key, count, first, last)
+
+    def spill(self, block_size=65536):
+        # writes the records in memory to a run file sorted by key and starts over with an empty set
+        if not self.records:
+            return
+        records = sorted(self.records.items(), key=operator.itemgetter(0))
+        self.records = {}
+        with tempfile.NamedTemporaryFile(prefix="brocess.spill.", dir=self.spill_dir, delete=False) as f:
+            for i in range(0, len(records), block_size):
+                block = pack(dict(records[i:i + block_size]))
+                f.write(_BLOCK.pack(len(block)))
+                f.write(block)
+        self.runs.append((f.name, len(records)))
+
+    def adopt(self, runs):
+        # takes over runs spilled by another aggregator, e.g. in a worker process, to merge and remove them
+        self.runs.extend(runs)
+
+    def items(self, records=None):
+        # the lifetime counts, summed over every day when counting per day
+        if records is None:
+            records = self.records
+        if self.daily and isinstance(records, SpilledRecords):
+            # spilled records come sorted with the day last, so the days of a key follow one another
+            pairs = _combine(records.items(), lambda key: key[:-1])
+        elif self.daily:
+            lifetime = Aggregator(self.fields)
+            for key, (count, first, last) in records.items():
+                lifetime._add(key[:-1], count, first, last)
+            pairs = lifetime.records.items()
+        else:
+            pairs = records.items()
+        for key, (count, first, last) in pairs:
+            data = dict(zip(self.fields, key))
+            data["ts"] = first
+            data["last_ts"] = last
+            yield data, count
+
+    def days(self, records=None):
+        # the counts per day, with the day as a YYYY-MM-DD string
+        if records is None:
+            records = self.records
+        for key, (count, first, last) in records.items():
+            data = dict(zip(self.fields, key))
+            data["day"] = day_string(key[-1])
+            data["ts"] = first
+            data["last_ts"] = last
+            yield data, count
+
+    def take(self):
+        # hands over the records collected so far and starts a new, empty set.  once anything has been spilled
+        # they come as SpilledRecords, which release() removes after they have been written
+        runs, records = self.take_runs()
+        if runs:
+            return SpilledRecords(runs, records)
+        return records
+
+    def take_runs(self):
+        # hands over the spilled runs and the records in memory separately
+        runs, records = self.runs, self.records
+        self.runs = []
+        self.records = {}
+        return runs, records
+
+    def restore(self, runs, records):
+        # puts back what take_runs() handed over, folding in anything collected since
+        current = self.records
+        self.runs = runs + self.runs
+        self.records = records
+        self.merge(current)
+
+    def release(self, records):
+        if isinstance(records, SpilledRecords):
+            records.close()
+
+    def clear(self):
+        self.release(SpilledRecords(self.runs, {}))
+        self.runs = []
+        self.records = {}
+
+
+def _combine(pairs, keyfunc):
+    # sums runs of consecutive (key, [count, first, last]) pairs whose keys keyfunc maps to the same key
+    current = None
+    for key, (count, first, last) in pairs:
+        key = keyfunc(key)
+        if current is not None and key == current[0]:
+            record = current[1]
+            record[0] += count
+            if first < record[1]:
+                record[1] = first
+            if last > record[2]:
+                record[2] = last
+            continue
+        if current is not None:
+            yield current
+        current = (key, [count, first, last])
+    if current is not None:
+        yield current
+
+
+def _read_run(path):
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(_BLOCK.size)
+            if not header:
+                return
+            for key, count, first, last in unpack(f.read(_BLOCK.unpack(header)[0])):
+                yield key, [count, first, last]
+
+
+class SpilledRecords(object):
+    # spilled runs and the records left in memory, read back with a k-way merge as a single stream sorted by
+    # key in which every key appears once.  it can be read more than once, e.g. when a batch is retried
+    def __init__(self, runs, records):
+        self.runs = runs
+        self.records = sorted(records.items(), key=operator.itemgetter(0))
+        # the number of distinct keys, known once they have been read through
+        self.numrecords = None
+
+    def __len__(self):
+        if self.numrecords is not None:
+            return self.numrecords
+        # at most this many, as a key may be in more than one run
+        return sum(numrecords for path, numrecords in self.runs) + len(self.records)
+
+    def items(self):
+        streams = [_read_run(path) for path, numrecords in self.runs] + [iter(self.records)]
+        numrecords = 0
+        for item in _combine(heapq.merge(*streams, key=operator.itemgetter(0)), lambda key: key):
+            numrecords += 1
+            yield item
+        self.numrecords = numrecords
+
+    def close(self):
+        for path, numrecords in self.runs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.runs = []
+
+
+def _typecode(values):
+    # the smallest unsigned array type that holds every value
+    largest = max(values, default=0)
+    for typecode in "BHI":
+        if largest < 1 << (8 * array.array(typecode).itemsize):
+            return typecode
+    return "Q"
+
+
+def _section(typecode, data):
+    return _SECTION.pack(typecode.encode(), len(data)) + data
+
+
+def _read_section(view, offset):
+    typecode, size = _SECTION.unpack_from(view, offset)
+    offset += _SECTION.size
+    if typecode == b"-":
+        return bytes(view[offset:offset + size]), offset + size
+    values = array.array(typecode.decode())
+    values.frombytes(view[offset:offset + size])
+    return values, offset + size
+
+
+def _split(lengths, blob):
+    ends = list(itertools.accumulate(lengths))
+    return [blob[end - length:end] for length, end in zip(lengths, ends)]
+
+
+def pack(records):
+    # serializes aggregated records column by column into arrays of the smallest type that fits, far smaller
+    # than a pickled dict.  bytes and str columns with few distinct values, such as ports and connection
+    # states, are stored once per value with an index per record.  every key must have the same kinds of columns
+    counts = [record[0] for record in records.values()]
+    sections = [_section(_typecode(counts), array.array(_typecode(counts), counts).tobytes()),
+                _section("d", array.array("d", [record[1] for record in records.values()]).tobytes()),
+                _section("d", array.array("d", [record[2] for record in records.values()]).tobytes())]
+    columns = list(zip(*records)) if records else []
+    for column in columns:
+        if not isinstance(column[0], (bytes, str)):
+            sections.append(b"i" + _section(_typecode(column), array.array(_typecode(column), column).tobytes()))
+            continue
+        kind = b"b"
+        if isinstance(column[0], str):
+            kind = b"s"
+            column = [value.encode("utf-8", "surrogateescape") for value in column]
+        distinct = dict.fromkeys(column)
+        values = column
+        if len(distinct) * 2 <= len(column):
+            kind = kind.upper()
+            values = list(distinct)
+            for i, value in enumerate(values):
+                distinct[value] = i
+        lengths = [len(value) for value in values]
+        sections.append(kind + _section(_typecode(lengths), array.array(_typecode(lengths), lengths).tobytes()) +
+                        _section("-", b"".join(values)))
+        if kind.isupper():
+            indexes = [distinct[value] for value in column]
+            sections.append(_section(_typecode(indexes), array.array(_typecode(indexes), indexes).tobytes()))
+    return _HEADER.pack(len(records), len(columns)) + b"".join(sections)
+
+
+def unpack(data):
+    # returns a list of (key, count, first, last) from the output of pack()
+    view = memoryview(data)
+    numrecords, numcolumns = _HEADER.unpack_from(view)
+    offset = _HEADER.size
+    counts, offset = _read_section(view, offset)
+    firsts, offset = _read_section(view, offset)
+    lasts, offset = _read_section(view, offset)
+    columns = []
+    for i in range(numcolumns):
+        kind = bytes(view[offset:offset + 1]).decode()
+        offset += 1
+        if kind == "i":
+            column, offset = _read_section(view, offset)
+            columns.append(column)
+            continue
+        lengths, offset = _read_section(view, offset)
+        blob, offset = _read_section(view, offset)
+        values = _split(lengths, blob)
+        if kind in "sS":
+            values = [value.decode("utf-8", "surrogateescape") for value in values]
+        if kind.isupper():
+            indexes, offset = _read_section(view, offset)
+            values = [values[index] for index in indexes]
+        columns.append(values)
+    view.release()
+    keys = zip(*columns) if columns else [()] * numrecords
+    return list(zip(keys, counts, firsts, lasts))
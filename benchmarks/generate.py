@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# writes synthetic gzip'd bro conn, smtp and http logs.  keys are drawn from pools of a given cardinality with
+# zipf distributed popularity, so a few keys make up most lines as they do on a real sensor
+
+import argparse
+import gzip
+import itertools
+import json
+import os
+import random
+
+CONN_FIELDS = ("ts", "uid", "id.orig_h", "id.orig_p", "id.resp_h", "id.resp_p", "proto", "service", "duration",
+               "orig_bytes", "resp_bytes", "conn_state", "local_orig", "missed_bytes", "history")
+SMTP_FIELDS = ("ts", "uid", "id.orig_h", "id.orig_p", "id.resp_h", "id.resp_p", "trans_depth", "helo", "mailfrom",
+               "rcptto")
+HTTP_FIELDS = ("ts", "uid", "id.orig_h", "id.orig_p", "id.resp_h", "id.resp_p", "trans_depth", "method", "host",
+               "uri")
+PORTS = ("80", "443", "53", "25", "22", "123", "8080", "3389")
+STATES = ("SF", "SF", "SF", "S0", "REJ", "RSTO", "OTH")
+TLDS = ("com", "net", "org", "co.uk", "io", "de")
+
+
+def _picker(rng, pool, skew):
+    # returns a function drawing n items from pool, the i-th most popular with weight 1 / i**skew
+    weights = list(itertools.accumulate(1.0 / (i + 1) ** skew for i in range(len(pool))))
+    return lambda n: rng.choices(pool, cum_weights=weights, k=n)
+
+
+def _address(rng, ipv6):
+    if ipv6:
+        return "2001:db8:{:x}:{:x}::{:x}".format(rng.randrange(65536), rng.randrange(65536), rng.randrange(65536))
+    return "{}.{}.{}.{}".format(rng.randrange(1, 224), rng.randrange(256), rng.randrange(256), rng.randrange(1, 255))
+
+
+def _write(path, fields, rows, fmt):
+    with gzip.open(path, "wt", compresslevel=6) as f:
+        if fmt == "json":
+            for row in rows:
+                f.write(json.dumps(dict((field, value) for field, value in zip(fields, row) if value != "-")) + "\n")
+            return
+        f.write("#separator \\x09\n#set_separator\t,\n#empty_field\t(empty)\n#unset_field\t-\n#path\tbench\n"
+                "#open\t2018-01-01-00-00-00\n")
+        f.write("#fields\t" + "\t".join(fields) + "\n#types\t" + "\t".join("string" for field in fields) + "\n")
+        for row in rows:
+            f.write("\t".join(row) + "\n")
+        f.write("#close\t2018-01-01-01-00-00\n")
+
+
+def generate(outdir, lines=100000, cardinality=10000, skew=1.1, ipv6=0.1, seed=1, fmt="tsv"):
+    # returns {logtype: path} of the logs written to outdir
+    rng = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+    start = 1500000000.0
+    timestamps = ["%.6f" % (start + i * 3600.0 / lines) for i in range(lines)]
+    paths = {}
+
+    internal = ["10.{}.{}.{}".format(rng.randrange(4), rng.randrange(256), rng.randrange(1, 255))
+                for i in range(max(1, cardinality // 100))]
+    external = [_address(rng, rng.random() < ipv6) for i in range(cardinality)]
+    sources = _picker(rng, internal, skew)(lines)
+    destinations = _picker(rng, external, skew)(lines)
+    ports = _picker(rng, list(PORTS), skew)(lines)
+    rows = []
+    for i in range(lines):
+        rows.append((timestamps[i], "C" + str(i), sources[i], str(rng.randrange(1024, 65536)), destinations[i],
+                     ports[i], "tcp", "-", "%.3f" % rng.random(), str(rng.randrange(10000)),
+                     str(rng.randrange(100000)), rng.choice(STATES), "T", "0", "ShADadFf"))
+    paths["conn"] = os.path.join(outdir, "conn.00.log.gz")
+    _write(paths["conn"], CONN_FIELDS, rows, fmt)
+
+    domains = ["{}{}.{}".format(rng.choice("abcdefghijklmnopqrstuvwxyz"), i, rng.choice(TLDS))
+               for i in range(max(1, cardinality // 10))]
+    hosts = [rng.choice(("www.", "cdn.", "api.", "", "a.b.")) + rng.choice(domains) for i in range(cardinality)]
+    http = _picker(rng, hosts + ["-"], skew)(lines)
+    rows = []
+    for i in range(lines):
+        rows.append((timestamps[i], "C" + str(i), sources[i], "1024", destinations[i], "80", "1", "GET", http[i],
+                     "/"))
+    paths["http"] = os.path.join(outdir, "http.00.log.gz")
+    _write(paths["http"], HTTP_FIELDS, rows, fmt)
+
+    mailboxes = ["user{}@{}".format(i, rng.choice(domains)) for i in range(cardinality)]
+    senders = _picker(rng, mailboxes, skew)(lines)
+    recipients = _picker(rng, mailboxes, skew)(lines * 2)
+    rows = []
+    for i in range(lines):
+        rcptto = recipients[2 * i] if rng.random() < 0.8 else ",".join(recipients[2 * i:2 * i + 2])
+        rows.append((timestamps[i], "C" + str(i), sources[i], "1024", destinations[i], "25", "1", "mail",
+                     "<" + senders[i] + ">", rcptto))
+    paths["smtp"] = os.path.join(outdir, "smtp.00.log.gz")
+    _write(paths["smtp"], SMTP_FIELDS, rows, fmt)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic gzip'd bro conn, smtp and http logs.")
+    parser.add_argument("outdir", help="Directory the logs are written to.")
+    parser.add_argument("-n", "--lines", type=int, default=100000, help="Lines per log. Defaults to 100000")
+    parser.add_argument("-k", "--cardinality", type=int, default=10000,
+                        help="Number of distinct destinations, hosts and mailboxes. Defaults to 10000")
+    parser.add_argument("-s", "--skew", type=float, default=1.1,
+                        help="Zipf exponent of key popularity, 0 for uniform. Defaults to 1.1")
+    parser.add_argument("--ipv6", type=float, default=0.1, help="Fraction of IPv6 destinations. Defaults to 0.1")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed. Defaults to 1")
+    parser.add_argument("--format", choices=("tsv", "json"), default="tsv", dest="fmt",
+                        help="Write tab separated or JSON logs. Defaults to tsv")
+    args = parser.parse_args()
+    for logtype, path in sorted(generate(args.outdir, args.lines, args.cardinality, args.skew, args.ipv6, args.seed,
+                                         args.fmt).items()):
+        print("wrote {}".format(path))
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+#
+# runs brocess over synthetic logs with each backend and prints rows/s, database statements, peak RSS and
+# per-stage timings as JSON.  every run happens in a fresh process so peak RSS belongs to that run alone
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import generate  # noqa: E402
+
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+
+class CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args):
+        self._counter["statements"] += 1
+        return self._cursor.execute(*args)
+
+    def executemany(self, query, rows):
+        rows = list(rows)
+        self._counter["statements"] += 1
+        self._counter["executemany_rows"] += len(rows)
+        return self._cursor.executemany(query, rows)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection(object):
+    # counts every statement a backend sends through its connection
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self):
+        return CountingCursor(self._connection.cursor(), self._counter)
+
+    def execute(self, *args):
+        self._counter["statements"] += 1
+        return self._connection.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class StubCursor(object):
+    # accepts every statement without a server.  count queries report no rows, so the schema checks pass
+    rowcount = 0
+
+    def __init__(self):
+        self._result = None
+
+    def execute(self, query, args=None):
+        self._result = (0,) if query.lstrip().lower().startswith("select count") else None
+
+    def executemany(self, query, rows):
+        for row in rows:
+            self.execute(query, row)
+
+    def fetchone(self):
+        return self._result
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class StubConnection(object):
+    # stands in for a MySQL server, quoting values the way pymysql does so the statements are built in full
+    def cursor(self):
+        return StubCursor()
+
+    def literal(self, value):
+        return pymysql.converters.escape_item(value, "utf8mb4")
+
+    def commit(self):
+        pass
+
+    def ping(self, reconnect=True):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _timed_lines(lines, stages):
+    while True:
+        start = time.perf_counter()
+        try:
+            line = next(lines)
+        except StopIteration:
+            stages["read"] += time.perf_counter() - start
+            return
+        stages["read"] += time.perf_counter() - start
+        yield line
+
+
+def _timed(function, stages, stage, counter=None):
+    def timed(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            stages[stage] += time.perf_counter() - start
+            if counter is not None:
+                counter["aggregated_keys"] += len(args[0][0])
+    return timed
+
+
+def run_case(case):
+    # parses one log into one backend and returns its measurements
+    import brocess
+    import whitelist
+    logging.basicConfig(level=logging.WARNING)
+
+    counter = {"statements": 0, "executemany_rows": 0, "aggregated_keys": 0}
+    module = __import__(case["backend"] + "db")
+    if case["backend"] == "sqlite":
+        module.sqlite3 = types.SimpleNamespace(
+            connect=lambda *args, **kwargs: CountingConnection(sqlite3.connect(*args, **kwargs), counter))
+    else:
+        connect = (lambda **kwargs: StubConnection()) if case["stub"] else pymysql.connect
+        module.pymysql = types.SimpleNamespace(
+            connect=lambda **kwargs: CountingConnection(connect(**kwargs), counter))
+
+    args = types.SimpleNamespace(dbtype=case["backend"], database=case["database"], dboptions=case["dboptions"],
+                                 options=case["options"])
+    whitelists = whitelist.compile_whitelists(dict((name, {}) for name in whitelist.matchers))
+    logprocess = brocess.create_logprocess(case["logtype"], args, whitelists)
+
+    # flush is the time parsing waited on flushes, write the time spent writing on any thread
+    stages = dict.fromkeys(("open", "read", "parse", "flush", "write", "close"), 0.0)
+    read_lines = logprocess._read_lines
+    logprocess._read_lines = lambda filepath: _timed_lines(read_lines(filepath), stages)
+    logprocess._write_records = _timed(logprocess._write_records, stages, "write", counter)
+    logprocess.flush = _timed(logprocess.flush, stages, "flush")
+
+    start = time.perf_counter()
+    logprocess.open()
+    stages["open"] = time.perf_counter() - start
+    parsestart = time.perf_counter()
+    numrecords = logprocess.parse(case["path"])
+    del logprocess.flush
+    # parse is what is left once reading and the flushes made while parsing are taken out
+    stages["parse"] = time.perf_counter() - parsestart - stages["read"] - stages["flush"]
+    closestart = time.perf_counter()
+    logprocess.close()
+    stages["close"] = time.perf_counter() - closestart
+    seconds = time.perf_counter() - start
+
+    return {
+        "backend": case["backend"],
+        "stub": case["stub"],
+        "logtype": case["logtype"],
+        "lines": numrecords,
+        "seconds": round(seconds, 6),
+        "rows_per_second": round(numrecords / seconds, 1),
+        "aggregated_keys": counter["aggregated_keys"],
+        "statements": counter["statements"],
+        "executemany_rows": counter["executemany_rows"],
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "stages": dict((stage, round(elapsed, 6)) for stage, elapsed in stages.items()),
+    }
+
+
+def _options(pairs):
+    options = {}
+    for pair in pairs or ():
+        key, value = pair.split("=", 1)
+        options[key.strip()] = value.strip()
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark brocess backends on synthetic bro logs.")
+    parser.add_argument("-b", "--backend", action="append", dest="backends", choices=("sqlite", "mysql", "mysqli"),
+                        help="Backend to run, may be given more than once. Defaults to every backend.")
+    parser.add_argument("-l", "--logtype", action="append", dest="logtypes", choices=("conn", "smtp", "http"),
+                        help="Log type to run, may be given more than once. Defaults to every log type.")
+    parser.add_argument("--logs", help="Directory with conn.00.log.gz, smtp.00.log.gz and http.00.log.gz to use "
+                                       "instead of generating them.")
+    parser.add_argument("-n", "--lines", type=int, default=100000, help="Lines per generated log. Defaults to 100000")
+    parser.add_argument("-k", "--cardinality", type=int, default=10000,
+                        help="Number of distinct keys in the generated logs. Defaults to 10000")
+    parser.add_argument("-s", "--skew", type=float, default=1.1,
+                        help="Zipf exponent of key popularity. Defaults to 1.1")
+    parser.add_argument("--ipv6", type=float, default=0.1, help="Fraction of IPv6 destinations. Defaults to 0.1")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed. Defaults to 1")
+    parser.add_argument("--format", choices=("tsv", "json"), default="tsv", dest="fmt",
+                        help="Generate tab separated or JSON logs. Defaults to tsv")
+    parser.add_argument("--mysql-database", dest="mysql_database",
+                        help="Connection string of a scratch MySQL database (server=...;database=...;uid=...;pwd=...) "
+                             "for the mysql and mysqli backends.  Without it they run against a stub connection.")
+    parser.add_argument("-o", "--option", action="append", dest="options",
+                        help="A [main] option as key=value, e.g. flush_size=100000. May be given more than once.")
+    parser.add_argument("-O", "--dboption", action="append", dest="dboptions",
+                        help="A backend option as key=value, e.g. batch_size=5000. May be given more than once.")
+    parser.add_argument("--output", help="File the JSON report is written to. Defaults to stdout.")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="brocess-bench.")
+    generator = None
+    if args.logs:
+        paths = dict((logtype, os.path.join(args.logs, logtype + ".00.log.gz")) for logtype in ("conn", "smtp", "http"))
+    else:
+        generator = {"lines": args.lines, "cardinality": args.cardinality, "skew": args.skew, "ipv6": args.ipv6,
+                     "seed": args.seed, "format": args.fmt}
+        paths = generate.generate(workdir, args.lines, args.cardinality, args.skew, args.ipv6, args.seed, args.fmt)
+
+    results = []
+    for backend in args.backends or ("sqlite", "mysql", "mysqli"):
+        for logtype in args.logtypes or ("conn", "smtp", "http"):
+            case = {"backend": backend, "logtype": logtype, "path": paths[logtype], "stub": False,
+                    "options": _options(args.options), "dboptions": _options(args.dboptions)}
+            if backend == "sqlite":
+                case["database"] = os.path.join(workdir, "{}.{}.db".format(backend, logtype))
+            elif not pymysql:
+                results.append({"backend": backend, "logtype": logtype, "skipped": "pymysql is not installed"})
+                continue
+            elif args.mysql_database:
+                case["database"] = args.mysql_database
+            else:
+                case["database"] = "server=localhost;database=brocess;uid=bench;pwd=bench"
+                case["stub"] = True
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                results.append(pool.apply(run_case, (case,)))
+            sys.stderr.write("{backend} {logtype}: {rows_per_second} rows/s\n".format(**results[-1]))
+
+    shutil.rmtree(workdir)
+
+    report = {"python": platform.python_version(), "generator": generator, "options": _options(args.options),
+              "dboptions": _options(args.dboptions), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,87 +1,379 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
+import collections
 import configparser
 import fnmatch
+import functools
+import glob
 import gzip
+import json
 import logging
 import logging.config
+import multiprocessing
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
 import os
-import socket
+import shutil
+import signal
+import subprocess
 import sys
 import time
 import traceback
+import uuid
+
+import metrics
+import watch
+import whitelist
+from writer import AsyncWriter
+from address import pack_address
+from aggregate import Aggregator, pack
+from ledger import file_identity
+from publicsuffix import PublicSuffixList
+from reader import detect_reader
+from sketch import ConnSketch
 
 
 class LogProcess(object):
-    def __init__(self, dbtype, database):
+    # the name metrics are labelled with
+    logtype = None
+    # the key fields each distinct record is aggregated on before it is written
+    fields = ()
+    # the log columns _parse_line needs, in the order they are handed to it
+    columns = ()
+    # bytes of decompressed log read at a time
+    chunk_size = 1048576
+
+    def __init__(self, dbtype, database, dboptions=None, options=None):
+        self.dbtype = dbtype
+        self.database = database
+        self.dboptions = dboptions
+        self.options = options if options else {}
+        self.reader = None
+        # number of distinct keys after which the aggregator is written out in the middle of a file, 0 for never
+        self.flush_size = int(self.options.get("flush_size", 0))
+        # record every file and how far into it has been committed, so reruns skip or resume it
+        self.use_ledger = configparser.ConfigParser.BOOLEAN_STATES.get(self.options.get("ledger", "").lower())
+        # ledger entries waiting to be committed together with the aggregated records they account for
+        self.ledger = []
+        # ledger entries set aside while a file is parsed apart from the ones before it
+        self.held = []
+        self.writer = None
+        self.db = None
+        self.props = {}
+        # also count every key per day for the rollup tables
+        self.rollups = configparser.ConfigParser.BOOLEAN_STATES.get(self.options.get("rollups", "").lower(), False)
+        # times a batch is written again after a lost connection, a deadlock or a lock timeout, waiting
+        # retry_backoff seconds before the first retry and twice as long before each one after it
+        self.write_retries = int(self.options.get("write_retries", 5))
+        self.retry_backoff = float(self.options.get("retry_backoff", 1))
+        # number of distinct keys after which the aggregator is spilled to a sorted run in spill_dir, 0 for
+        # never.  the runs are merged back when the records are written
+        self.spill_size = int(self.options.get("spill_size", 0))
+        self.aggregator = Aggregator(self.fields, daily=self.rollups, spill_dir=self.options.get("spill_dir") or None)
+        # whether the last file parsed was read to its end rather than cut off by a compression error
+        self.complete = True
+        # seconds spent in each stage of the file being parsed, and the records left out of it by reason
+        self.timings = {}
+        self.skipped = collections.Counter()
+
+    def open(self):
         try:
-            dbe = __import__(dbtype + "db")
+            dbe = __import__(self.dbtype + "db")
         except Exception as e:
-            logging.critical("Error loading database module: " + dbtype + ": " + str(e))
+            logging.critical("Error loading database module: " + self.dbtype + ": " + str(e))
             sys.exit(-1)
-        self.dbengine = dbe.DBEngine(database)
+        self.dbengine = dbe.DBEngine(self.database, self.dboptions)
         if not self.dbengine.open():
-            logging.critical("Could not connect to mysql database: " + database)
+            logging.critical("Could not connect to mysql database: " + self.database)
             sys.exit(-1)
         self.db = dbe.LogDB(self.dbengine)
-        self.db.instantiate()
-        self.props = {}
+        if not self.db.instantiate():
+            logging.critical("Unable to use database " + self.database + " with this version of brocess")
+            sys.exit(-1)
+        if configparser.ConfigParser.BOOLEAN_STATES.get(self.options.get("async_writer", "").lower()):
+            self.writer = AsyncWriter(self._write_records, int(self.options.get("writer_queue_size", 4)),
+                                      drop=self._drop_records)
+
+    def _open_reader(self, line):
+        # the first line of each file tells whether it is tab separated or json
+        self.reader = detect_reader(line, self.columns)
+        self.props = self.reader.props
+        # bound once per file so every line goes straight to the reader
+        self._get_line_data = self.reader.get_line_data
 
     def _process_prop(self, line):
-        if line.startswith("#close"):
-            return
-        line = str(line)[1:]
-        if line.startswith("separator"):
-            label, value = line.split()
-            value = chr(int(value.replace("\\", "0"), 16))
-        else:
-            label, value = line.split(self.props["separator"], 1)
-        if label not in ["fields", "types"]:
-            self.props[label] = value
-        else:
-            self.props[label] = value.split(self.props["separator"])
-        logging.debug("label " + label + "=" + str(self.props[label]))
+        self.reader.process_header(line)
 
     def _get_line_data(self, line):
-        elements = str(line).split(self.props["separator"])
-        if len(elements) != len(self.props["fields"]):
-            logging.error("ERROR processing line: " + line)
-            logging.error(
-                "Number of elements is: " + str(len(elements)) + ", should be: " + str(len(self.props["fields"])))
-            return
-        data = {}
-        i = 0
-        for item in self.props["fields"]:
-            data[item] = elements[i]
-            i += 1
-        return data
+        return self.reader.get_line_data(line)
 
     def _parse_line(self, line):
         raise NotImplemented
 
+    def _write_record(self, data, count):
+        raise NotImplemented
+
+    def _write_rollup(self, data, count):
+        raise NotImplemented
+
+    def _exact_items(self, records):
+        # the lifetime counts that are written as rows
+        return self.aggregator.items(records)
+
+    def _rollup_items(self, records):
+        # the counts per day that are written as rollup rows, after _exact_items() for the same records
+        return self.aggregator.days(records)
+
+    def _observe(self, stage, seconds):
+        metrics.registry.observe("brocess_stage_seconds", seconds, logtype=self.logtype, stage=stage)
+
+    def _write_records(self, batch):
+        # a failed batch is written again from the start on a new connection.  its id is committed with it, so
+        # a batch whose commit went through before the connection was lost is not counted twice
+        records, entries = batch
+        batchid = uuid.uuid4().hex
+        attempt = 0
+        try:
+            while True:
+                try:
+                    if attempt:
+                        self.db.reconnect()
+                        if self.db.batch_applied(batchid):
+                            logging.info("batch " + batchid + " was committed before the connection was lost")
+                            return
+                    else:
+                        self.db.check()
+                    self._write_batch(records, entries, batchid)
+                    return
+                except Exception as e:
+                    attempt += 1
+                    if attempt > self.write_retries or not self.db.retryable(e):
+                        # whatever of the batch was written or queued must not be committed with the next one
+                        self.db.discard()
+                        raise
+                    delay = min(self.retry_backoff * 2 ** (attempt - 1), 60)
+                    logging.warning("Unable to write batch " + batchid + ": " + str(e) + ", retrying in " +
+                                    str(delay) + " seconds")
+                    metrics.registry.inc("brocess_write_retries_total", logtype=self.logtype)
+                    time.sleep(delay)
+        finally:
+            # spilled runs are removed once the batch is written or given up on
+            self.aggregator.release(records)
+
+    def _drop_records(self, batch):
+        # a batch the writer thread leaves out after an earlier one failed, whose spilled runs are removed
+        records, entries = batch
+        self.aggregator.release(records)
+
+    def _write_batch(self, records, entries, batchid):
+        start = time.perf_counter()
+        for data, count in self._exact_items(records):
+            self._write_record(data, count)
+        if self.rollups:
+            for data, count in self._rollup_items(records):
+                self._write_rollup(data, count)
+        for entry in entries:
+            self.db.record_ingested_file(entry)
+        # write covers the add_* calls, including any table batches that filled up, commit the final flush
+        queued = time.perf_counter()
+        self.db.flush(batchid)
+        self._observe("write", queued - start)
+        self._observe("commit", time.perf_counter() - queued)
+        metrics.registry.inc("brocess_records_written_total", len(records), logtype=self.logtype)
+        logging.debug("flushed " + str(len(records)) + " aggregated records")
+
+    def flush(self):
+        records = self.aggregator.take()
+        entries = self.ledger
+        self.ledger = []
+        if not records and not entries:
+            return
+        if self.writer:
+            self.writer.put((records, entries))
+        else:
+            self._write_records((records, entries))
+
+    def check_ledger(self, filepath):
+        # identifies filepath and returns its ledger entry, with the number of lines already committed as its
+        # lineoffset, or None when the file has been ingested completely
+        entry = file_identity(filepath)
+        for pending in self.held + self.ledger:
+            if pending["digest"] == entry["digest"] and pending["complete"]:
+                return None
+        if self.writer:
+            self.writer.join()
+        state = self.db.get_ingested_file(entry["digest"])
+        if state:
+            if state[1]:
+                return None
+            entry["lineoffset"] = state[0]
+        return entry
+
+    def checkpoint(self, entry, lineoffset, complete):
+        self.ledger.append(dict(entry, lineoffset=lineoffset, complete=complete))
+
+    def parse_apart(self, filepath):
+        # parses filepath with the records and ledger entries of earlier files set aside, and folds its own in
+        # with them only once it has been parsed, so a file that fails part way through leaves nothing behind.
+        # flushes made while it is parsed commit its records alone, with its checkpoints
+        runs, records = self.aggregator.take_runs()
+        self.held, self.ledger = self.ledger, []
+        try:
+            return self.parse(filepath)
+        except Exception:
+            self.aggregator.clear()
+            self.ledger = []
+            raise
+        finally:
+            self.aggregator.restore(runs, records)
+            self.ledger = self.held + self.ledger
+            self.held = []
+
+    def check_size(self):
+        # flushes or spills the records merged from several files once there are flush_size or spill_size of them
+        if self.flush_size and len(self.aggregator) >= self.flush_size:
+            self.flush()
+        elif self.spill_size and len(self.aggregator) >= self.spill_size:
+            self.aggregator.spill()
+
+    def discard(self):
+        # drops everything aggregated and not yet committed, e.g. after the file it came from failed, and lets
+        # a writer thread that failed take batches again
+        self.aggregator.clear()
+        self.ledger = []
+        if self.writer:
+            self.writer.reset()
+
+    def sync(self):
+        # writes out everything aggregated so far and waits until it has been committed
+        self.flush()
+        if self.writer:
+            self.writer.join()
+
+    def close(self):
+        self.sync()
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        self.db.close()
+
+    def _read_lines(self, filepath):
+        # decompresses in large chunks, either in process or through an external pigz/zcat, and yields each
+        # line as bytes without its newline
+        process = None
+        decompressor = self.options.get("decompressor", "gzip")
+        if decompressor != "gzip":
+            command = shutil.which(decompressor)
+            if command:
+                process = subprocess.Popen([command, "-dc", filepath], stdout=subprocess.PIPE,
+                                           stderr=subprocess.DEVNULL, bufsize=self.chunk_size)
+            else:
+                logging.warning("Unable to find " + decompressor + ", decompressing in process")
+        f = process.stdout if process else gzip.open(filepath, "rb")
+        try:
+            remainder = b""
+            while True:
+                start = time.perf_counter()
+                chunk = f.read(self.chunk_size)
+                self.timings["read"] += time.perf_counter() - start
+                if not chunk:
+                    break
+                lines = (remainder + chunk).split(b"\n")
+                remainder = lines.pop()
+                for line in lines:
+                    yield line
+            if remainder:
+                yield remainder
+            if process and process.wait() != 0:
+                raise EOFError(decompressor + " exited with " + str(process.returncode))
+        finally:
+            f.close()
+            if process and process.poll() is None:
+                process.kill()
+                process.wait()
+
+    def parse(self, filepath, offset=0):
+        # times reading, parsing and the flushes made along the way, and counts the lines and skipped records
+        self.timings = dict.fromkeys(("read", "ledger", "whitelist", "flush", "spill"), 0.0)
+        start = time.perf_counter()
+        numrecords = 0
+        try:
+            numrecords = self._parse(filepath, offset)
+        finally:
+            elapsed = time.perf_counter() - start
+            for stage, seconds in self.timings.items():
+                if seconds:
+                    self._observe(stage, seconds)
+            self._observe("parse", elapsed - sum(self.timings.values()))
+            metrics.registry.inc("brocess_files_total", logtype=self.logtype)
+            metrics.registry.inc("brocess_lines_total", numrecords, logtype=self.logtype)
+            for reason, count in self.skipped.items():
+                metrics.registry.inc("brocess_skipped_records_total", count, logtype=self.logtype, reason=reason)
+            self.skipped.clear()
+        return numrecords
+
+    def _parse(self, filepath, offset):
+        # reads a log file into the aggregator, skipping the records in its first offset lines.  a writer that
+        # keeps a ledger looks the offset up itself and checkpoints its position with every flush
+        self.props = {}
+        self.reader = None
+        self.complete = True
+        numrecords = 0
+        entry = None
+        if self.use_ledger and self.db:
+            start = time.perf_counter()
+            entry = self.check_ledger(filepath)
+            self.timings["ledger"] += time.perf_counter() - start
+            if entry is None:
+                logging.info(filepath + " has already been ingested, skipping")
+                return 0
+            offset = entry["lineoffset"]
+        if offset:
+            logging.info("resuming " + filepath + " after line " + str(offset))
+        try:
+            for line in self._read_lines(filepath):
+                numrecords += 1
+                if not line:
+                    break
+                if self.reader is None:
+                    self._open_reader(line)
+                if not line.startswith(b"#"):
+                    # header lines are always read again since the columns depend on them
+                    if numrecords <= offset:
+                        continue
+                    self._parse_line(line)
+                    if self.flush_size and self.db and len(self.aggregator) >= self.flush_size:
+                        if entry:
+                            self.checkpoint(entry, numrecords, False)
+                        start = time.perf_counter()
+                        self.flush()
+                        self.timings["flush"] += time.perf_counter() - start
+                    elif self.spill_size and len(self.aggregator) >= self.spill_size:
+                        start = time.perf_counter()
+                        self.aggregator.spill()
+                        self.timings["spill"] += time.perf_counter() - start
+                else:
+                    self._process_prop(line.decode().strip())
+        except EOFError:
+            logging.error(filepath + " has a compression error.  Skipping to next file.")
+            self.complete = False
+            if entry:
+                self.checkpoint(entry, numrecords, False)
+            return numrecords
+        if entry:
+            self.checkpoint(entry, numrecords, True)
+        return numrecords
+
     def start(self, filepath):
         logging.info("parsing " + filepath)
         benchmarktime = time.time()
-        numrecords = 0
-        with gzip.open(filepath, "rb") as f:
-            try:
-                for line in f:
-                    numrecords += 1
-                    line = line.decode().strip()
-                    if line == "":
-                        return
-                    if not line.startswith("#"):
-                        self._parse_line(line)
-                    else:
-                        self._process_prop(line)
-
-                self.db.close()
-
-            except EOFError:
-                logging.error(filepath + " has a compression error.  Skipping to next file.")
-            except:
-                logging.error(traceback.format_exc())
-                sys.exit(0)
+        try:
+            numrecords = self.parse(filepath)
+            self.close()
+        except Exception:
+            logging.error("Unable to process " + filepath + ": " + traceback.format_exc())
+            sys.exit(1)
         benchmarktime = time.time() - benchmarktime
         if numrecords == 0:
             return 0
@@ -89,97 +381,203 @@ class LogProcess(object):
 
 
 class ConnLog(LogProcess):
-    def __init__(self, dbtype, database, whitelist_src_ips, whitelist_dest_ips, whitelist_dest_ports):
-        super().__init__(dbtype, database)
+    logtype = "conn"
+    fields = ("id.orig_h", "id.resp_h", "id.resp_p", "conn_state")
+    columns = ("ts", "id.orig_h", "id.resp_h", "id.resp_p", "conn_state")
+
+    def __init__(self, dbtype, database, whitelist_src_ips, whitelist_dest_ips, whitelist_dest_ports,
+                 dboptions=None, options=None, sketch_watchlist=()):
+        super().__init__(dbtype, database, dboptions, options)
         self.whitelist_dest_ips = whitelist_dest_ips
         self.whitelist_dest_ports = whitelist_dest_ports
         self.whitelist_src_ips = whitelist_src_ips
+        # count connections approximately and keep exact rows only for frequent or watched keys
+        self.sketch = None
+        if configparser.ConfigParser.BOOLEAN_STATES.get(self.options.get("conn_sketch", "").lower()):
+            self.sketch = ConnSketch(threshold=int(self.options.get("sketch_threshold", 100)),
+                                     width=int(self.options.get("sketch_width", 32768)),
+                                     depth=int(self.options.get("sketch_depth", 4)),
+                                     precision=int(self.options.get("sketch_precision", 10)),
+                                     watchlist=sketch_watchlist)
+        # the keys of the batch being written that have exact rows
+        self._exact_keys = set()
 
     def _parse_line(self, line):
-        data = self._get_line_data(line)
-        if data["id.resp_h"] in self.whitelist_dest_ips or data["id.resp_p"] in self.whitelist_dest_ports or data[
-            "id.orig_h"] in self.whitelist_src_ips:
+        row = self._get_line_data(line)
+        if row is None:
+            self.skipped["malformed"] += 1
             return
-        try:
-            socket.inet_aton(data["id.orig_h"])
-        except:
-            logging.debug("Invalid sourceip IPv4 address " + data["id.orig_h"] + ", skipping...")
+        ts, orig_h, resp_h, resp_p, conn_state = row
+        start = time.perf_counter()
+        whitelisted = (resp_h in self.whitelist_dest_ips or resp_p in self.whitelist_dest_ports or
+                       orig_h in self.whitelist_src_ips)
+        self.timings["whitelist"] += time.perf_counter() - start
+        if whitelisted:
+            self.skipped["whitelisted"] += 1
             return
-        try:
-            socket.inet_aton(data["id.resp_h"])
-        except:
-            logging.debug("Invalid destip IPv4 address " + data["id.resp_h"] + ", skipping...")
+        sourceip = pack_address(orig_h)
+        if sourceip is None:
+            logging.debug("Invalid sourceip address " + orig_h + ", skipping...")
+            self.skipped["invalid_address"] += 1
+            return
+        destip = pack_address(resp_h)
+        if destip is None:
+            logging.debug("Invalid destip address " + resp_h + ", skipping...")
+            self.skipped["invalid_address"] += 1
             return
-        self.db.add_conn_record(data)
+        # only successful connections are kept apart from the rest, so bucket every other state together
+        conn_state = "SF" if conn_state == "SF" else "-"
+        self.aggregator.add((sourceip, destip, resp_p, conn_state), float(ts))
+
+    def _exact_items(self, records):
+        items = self.aggregator.items(records)
+        if self.sketch:
+            exact = self.sketch.update(self.db, list(items))
+            self._exact_keys = set(tuple(data[field] for field in self.fields) for data, count in exact)
+            return exact
+        return items
+
+    def _rollup_items(self, records):
+        # with a sketch, only the keys that have an exact row get daily rows, so the rollup tables stay as small
+        days = self.aggregator.days(records)
+        if self.sketch:
+            return ((data, count) for data, count in days
+                    if tuple(data[field] for field in self.fields) in self._exact_keys)
+        return days
+
+    def _write_record(self, data, count):
+        self.db.add_conn_record(data, count)
+
+    def _write_rollup(self, data, count):
+        self.db.add_conn_rollup(data, count)
 
 
 class SMTPLog(LogProcess):
-    def __init__(self, dbtype, database, whitelist_source, whitelist_destination):
-        super().__init__(dbtype, database)
+    logtype = "smtp"
+    fields = ("mailfrom", "rcptto")
+    columns = ("ts", "mailfrom", "rcptto")
+
+    def __init__(self, dbtype, database, whitelist_source, whitelist_destination, dboptions=None, options=None):
+        super().__init__(dbtype, database, dboptions, options)
         self.whitelist_source = whitelist_source
         self.whitelist_destination = whitelist_destination
 
     def _parse_line(self, line):
-        data = self._get_line_data(line)
+        row = self._get_line_data(line)
+        if row is None:
+            self.skipped["malformed"] += 1
+            return
+        ts, mailfrom, rcpttos = row
 
-        mailfrom = data["mailfrom"].strip().lower()
+        mailfrom = mailfrom.strip().lower()
         if mailfrom.startswith('<'):
             mailfrom = mailfrom[1:]
         if mailfrom.endswith('>'):
             mailfrom = mailfrom[:-1]
 
         if mailfrom == '' or mailfrom == '-':
+            self.skipped["blank_address"] += 1
             return
 
-        data["mailfrom"] = mailfrom
-        
+        ts = float(ts)
+
         # rcptto can be a list of email addresses
-        for rcptto in data["rcptto"].split(','):
+        for rcptto in rcpttos.split(','):
             rcptto = rcptto.strip().lower()
             if rcptto.startswith('<'):
                 rcptto = rcptto[1:]
             if rcptto.endswith('>'):
                 rcptto = rcptto[:-1]
 
-            if data["mailfrom"] in self.whitelist_source or rcptto in self.whitelist_destination:
+            start = time.perf_counter()
+            whitelisted = mailfrom in self.whitelist_source or rcptto in self.whitelist_destination
+            self.timings["whitelist"] += time.perf_counter() - start
+            if whitelisted:
+                self.skipped["whitelisted"] += 1
                 continue
 
-            data["rcptto"] = rcptto
-            if data["rcptto"] == '' or data["rcptto"] == '-':
+            if rcptto == '' or rcptto == '-':
+                self.skipped["blank_address"] += 1
                 continue
 
-            self.db.add_smtp_record(data)
+            self.aggregator.add((mailfrom, rcptto), ts)
 
-class HTTPLog(LogProcess):
-    def __init__(self, dbtype, database):
-        super().__init__(dbtype, database)
+    def _write_record(self, data, count):
+        self.db.add_smtp_record(data, count)
 
-    def _parse_line(self, line):
-        data = self._get_line_data(line)
+    def _write_rollup(self, data, count):
+        self.db.add_smtp_rollup(data, count)
 
-        # skip these blank entries
-        if data['host'] == '-' or data['host'] == '':
-            return
 
+class HTTPLog(LogProcess):
+    logtype = "http"
+    fields = ("host",)
+    columns = ("ts", "host")
+
+    def __init__(self, dbtype, database, dboptions=None, options=None):
+        super().__init__(dbtype, database, dboptions, options)
+        # the same few thousand hosts make up most requests, so their expansions are cached
+        self._expand_host = functools.lru_cache(maxsize=int(self.options.get("fqdn_cache_size", 65536)))(
+            self._expand_fqdn)
+        self.public_suffixes = None
+        if self.options.get("public_suffix_list"):
+            self.public_suffixes = PublicSuffixList.load(self.options["public_suffix_list"])
+        elif configparser.ConfigParser.BOOLEAN_STATES.get(self.options.get("skip_public_suffixes", "").lower()):
+            self.public_suffixes = PublicSuffixList()
+
+    def _expand_fqdn(self, host):
         # we want to track each component of the FQDN by itself
         # example www.facebook.com
         # com [1]
         # facebook.com [1]
         # www.facebook.com [1]
-        fqdn_split = data['host'].split('.')
-        fqdn_split.reverse()
-        current_fqdn = []
-        for domain_part in fqdn_split:
-            domain_part = domain_part.lower()
-            current_fqdn.insert(0, domain_part)
-            data['host'] = '.'.join(current_fqdn)
-            self.db.add_http_record(data)
+        # public suffixes such as com or co.uk are left out when a public suffix list is in use
+        labels = host.lower().split('.')
+        fqdns = []
+        for i in range(len(labels) - 1, -1, -1):
+            fqdn = '.'.join(labels[i:])
+            if self.public_suffixes and self.public_suffixes.is_public_suffix(fqdn, i == 0):
+                continue
+            fqdns.append(fqdn)
+        return tuple(fqdns)
+
+    def _parse_line(self, line):
+        row = self._get_line_data(line)
+        if row is None:
+            self.skipped["malformed"] += 1
+            return
+        ts, host = row
+
+        # skip these blank entries
+        if host == '-' or host == '':
+            self.skipped["blank_host"] += 1
+            return
+
+        ts = float(ts)
+        for fqdn in self._expand_host(host):
+            self.aggregator.add((fqdn,), ts)
+
+    def parse(self, filepath, offset=0):
+        before = self._expand_host.cache_info()
+        numrecords = super().parse(filepath, offset)
+        info = self._expand_host.cache_info()
+        logging.info("fqdn cache hits=" + str(info.hits - before.hits) + " misses=" +
+                     str(info.misses - before.misses) + " size=" +
+                     str(info.currsize) + "/" + str(info.maxsize))
+        return numrecords
+
+    def _write_record(self, data, count):
+        self.db.add_http_record(data, count)
+
+    def _write_rollup(self, data, count):
+        self.db.add_http_rollup(data, count)
+
 
 parser = argparse.ArgumentParser(description="Process a Bro log and place it in a database.")
 parser.add_argument("-L", "--logging-config-path", action="store", default="brocess_logging.ini", 
                     dest="logging_config_path", help="Path to logging configuration file.")
 parser.add_argument("-t", "--dbtype", action="store", dest="dbtype",
-                    help="The type of database to use: sqlite, mysql, or mysqli")
+                    help="The type of database to use: sqlite, mysql, mysqli or shard")
 parser.add_argument("-d", "--database", action="store", dest="database",
                     help="The database connection string to use.  This is simply a filename or :memory: for"
                          "sqlite databases and \"host,database,username,password\" for mysql")
@@ -195,14 +593,22 @@ parser.add_argument("-i", "--inifile", action="store", dest="inifile",
                     help="Specify the path to the ini file")
 parser.add_argument("-r", "--remove", action="store_true", dest="remove",
                     help="Remove the file from filesystem when finished.")
-parser.add_argument("filename", help="The filename to process.  If the filename does not match the patterns "
-                                     "provided (in --connlog or --smtplog), the program will exit with an "
-                                     "error")
+parser.add_argument("-j", "--workers", action="store", type=int, dest="workers",
+                    help="Number of worker processes used to parse files when processing more than one file.")
+parser.add_argument("-D", "--daemon", action="store_true", dest="daemon",
+                    help="Keep running and process new files as they are written to the given directories.")
+parser.add_argument("--poll-interval", action="store", type=float, dest="poll_interval",
+                    help="Seconds between checks for new files when running as a daemon.")
+parser.add_argument("filename", nargs="+",
+                    help="The filename to process.  If the filename does not match the patterns "
+                         "provided (in --connlog or --smtplog), the program will exit with an "
+                         "error.  Directories and glob patterns may also be given, in which case every "
+                         "matching file found is processed.")
 
 
 def reconcileINI(args):
     whitelists = {"conn_dest_whitelist_ips": {}, "conn_dest_whitelist_ports": {}, "smtp_whitelist_source": {},
-                  "smtp_whitelist_destination": {}, "conn_src_whitelist_ips": {}}
+                  "smtp_whitelist_destination": {}, "conn_src_whitelist_ips": {}, "conn_sketch_watchlist": {}}
 
     homedir = os.path.split(sys.argv[0])[0]
     if not args.inifile:
@@ -218,6 +624,8 @@ def reconcileINI(args):
         args.dbtype = config.get("main", "dbtype", fallback=None)
     if not args.database:
         args.database = config.get(args.dbtype, "database", fallback=None)
+    args.dboptions = dict(config[args.dbtype]) if args.dbtype in config else {}
+    args.options = dict(config["main"]) if "main" in config else {}
     if not args.eventlog:
         args.eventlog = config.get("main", "eventlog", fallback=None)
     if not args.connlog:
@@ -226,6 +634,10 @@ def reconcileINI(args):
         args.smtplog = config.get("watchlogs", "smtplog", fallback=None)
     if not args.httplog:
         args.httplog = config.get("watchlogs", "httplog", fallback=None)
+    if not args.workers:
+        args.workers = config.getint("main", "workers", fallback=1)
+    if not args.poll_interval:
+        args.poll_interval = config.getfloat("main", "poll_interval", fallback=5)
 
     for whitelist_type in whitelists:
         if whitelist_type in config.keys():
@@ -235,6 +647,275 @@ def reconcileINI(args):
     return args, whitelists
 
 
+def get_logtype(filename, args):
+    logtype = None
+    if args.connlog:
+        if fnmatch.fnmatch(filename, args.connlog):
+            logtype = "conn"
+    if args.smtplog:
+        if fnmatch.fnmatch(filename, args.smtplog):
+            logtype = "smtp"
+    if args.httplog:
+        if fnmatch.fnmatch(filename, args.httplog):
+            logtype = "http"
+    return logtype
+
+
+def create_logprocess(logtype, args, whitelists):
+    if logtype == "conn":
+        return ConnLog(args.dbtype, args.database, whitelist_src_ips=whitelists["conn_src_whitelist_ips"],
+                       whitelist_dest_ips=whitelists["conn_dest_whitelist_ips"],
+                       whitelist_dest_ports=whitelists["conn_dest_whitelist_ports"],
+                       sketch_watchlist=whitelists["conn_sketch_watchlist"],
+                       dboptions=args.dboptions, options=args.options)
+    if logtype == "smtp":
+        return SMTPLog(args.dbtype, args.database, whitelist_source=whitelists["smtp_whitelist_source"],
+                       whitelist_destination=whitelists["smtp_whitelist_destination"],
+                       dboptions=args.dboptions, options=args.options)
+    if logtype == "http":
+        return HTTPLog(args.dbtype, args.database, dboptions=args.dboptions, options=args.options)
+    return None
+
+
+def find_logfiles(paths):
+    # expands files, directories and glob patterns into a sorted list of files
+    logfiles = set()
+    for path in paths:
+        matches = [path] if os.path.exists(path) else glob.glob(path, recursive=True)
+        for match in matches:
+            if os.path.isfile(match):
+                logfiles.add(match)
+                continue
+            for dirpath, dirnames, filenames in os.walk(match):
+                for filename in filenames:
+                    logfiles.add(os.path.join(dirpath, filename))
+    return sorted(logfiles)
+
+
+# state of a worker process in the parse pool, set up by _init_worker
+_worker = {}
+
+
+def _init_worker(args, whitelists):
+    _worker["args"] = args
+    _worker["whitelists"] = whitelists
+    _worker["logprocesses"] = {}
+
+
+def _parse_worker(task):
+    logtype, filepath, offset = task
+    logprocess = _worker["logprocesses"].get(logtype)
+    if not logprocess:
+        logprocess = create_logprocess(logtype, _worker["args"], _worker["whitelists"])
+        _worker["logprocesses"][logtype] = logprocess
+    logprocess.aggregator.clear()
+    try:
+        numrecords = logprocess.parse(filepath, offset)
+        runs, records = logprocess.aggregator.take_runs()
+        shared = _share(pack(records)) if records else None
+    except Exception:
+        logging.error("Unable to parse " + filepath + ": " + traceback.format_exc())
+        return logtype, filepath, None, False, None, [], metrics.registry.take()
+    # the metrics recorded here go back with the records so the parent reports them.  runs the worker spilled
+    # stay on disk and are handed over by name
+    return logtype, filepath, numrecords, logprocess.complete, shared, runs, metrics.registry.take()
+
+
+def _share(data):
+    # places packed records in a shared memory block for the parent to merge and unlink, and returns its name
+    # and size.  only the name goes through the pool's pipe
+    block = multiprocessing.shared_memory.SharedMemory(create=True, size=len(data))
+    block.buf[:len(data)] = data
+    block.close()
+    return block.name, len(data)
+
+
+def _merge_shared(aggregator, shared):
+    name, size = shared
+    block = multiprocessing.shared_memory.SharedMemory(name=name)
+    try:
+        aggregator.merge_packed(block.buf[:size])
+    finally:
+        block.close()
+        block.unlink()
+
+
+def ingest(logfiles, args, whitelists):
+    # parses many files, on a pool of worker processes when asked to, and merges their partial counts into a
+    # single writer per log type so every distinct key is written once for the whole run
+    tasks = []
+    for logfile in logfiles:
+        logtype = get_logtype(os.path.split(logfile)[1], args)
+        if not logtype:
+            logging.debug("No pattern match for " + logfile + ", skipping")
+            continue
+        tasks.append((logtype, logfile))
+    if not tasks:
+        # e.g. a sensor directory holding nothing but logs that are not ingested
+        logging.info("No logs matching a pattern in " + " ".join(args.filename) + ", nothing to do")
+        return
+
+    benchmarktime = time.time()
+    writers = {}
+    for logtype in set(logtype for logtype, logfile in tasks):
+        writers[logtype] = create_logprocess(logtype, args, whitelists)
+        writers[logtype].open()
+
+    totalrecords = 0
+    # the files of each log type that are done, removed with -r once its writer has committed them
+    finished = dict((logtype, []) for logtype in writers)
+    if args.workers > 1 and len(tasks) > 1:
+        # workers have no database, so the ledger is consulted here and the offset to resume from handed out
+        entries = {}
+        digests = {}
+        copies = {}
+        pooltasks = []
+        for logtype, logfile in tasks:
+            offset = 0
+            if writers[logtype].use_ledger:
+                entries[logfile] = writers[logtype].check_ledger(logfile)
+                if entries[logfile] is None:
+                    logging.info(logfile + " has already been ingested, skipping")
+                    finished[logtype].append(logfile)
+                    continue
+                # a copy of a file handed out already is skipped, as it is once the first one is in the ledger
+                # when parsing in this process, and done once the first one has been parsed
+                digest = entries[logfile]["digest"]
+                if digest in digests:
+                    logging.info(logfile + " is a copy of " + digests[digest] + ", skipping")
+                    copies.setdefault(digests[digest], []).append((logtype, logfile))
+                    continue
+                digests[digest] = logfile
+                offset = entries[logfile]["lineoffset"]
+            pooltasks.append((logtype, logfile, offset))
+        logging.info("parsing " + str(len(pooltasks)) + " files with " + str(args.workers) + " workers")
+        # workers share the parent's resource tracker, so a block they create is tracked once and forgotten
+        # when the parent unlinks it
+        multiprocessing.resource_tracker.ensure_running()
+        with multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(args, whitelists)) as pool:
+            for logtype, logfile, numrecords, complete, shared, runs, snapshot in pool.imap_unordered(
+                    _parse_worker, pooltasks):
+                metrics.registry.merge(snapshot)
+                if numrecords is None:
+                    continue
+                writer = writers[logtype]
+                writer.aggregator.adopt(runs)
+                if shared:
+                    _merge_shared(writer.aggregator, shared)
+                if entries.get(logfile):
+                    # a file cut off by a compression error is recorded as far as it was read, as it is when
+                    # parsed in this process
+                    writer.checkpoint(entries[logfile], numrecords, complete)
+                writer.check_size()
+                totalrecords += numrecords
+                finished[logtype].append(logfile)
+                for copytype, copy in copies.get(logfile, []):
+                    finished[copytype].append(copy)
+                logging.info("parsed " + repr(numrecords) + " records from " + logfile)
+    else:
+        for logtype, logfile in tasks:
+            logging.info("parsing " + logfile)
+            try:
+                numrecords = writers[logtype].parse_apart(logfile)
+            except Exception:
+                logging.error("Unable to parse " + logfile + ": " + traceback.format_exc())
+                continue
+            writers[logtype].check_size()
+            totalrecords += numrecords
+            finished[logtype].append(logfile)
+
+    # each log type is committed on its own, so one that fails leaves the others written and their files removed
+    failed = False
+    for logtype, writer in writers.items():
+        try:
+            writer.close()
+        except Exception:
+            logging.error("Unable to write the " + logtype + " records: " + traceback.format_exc())
+            failed = True
+            continue
+        if args.remove:
+            for logfile in finished[logtype]:
+                try:
+                    os.remove(logfile)
+                except:
+                    logging.critical("Unable to remove file: " + logfile)
+
+    benchmarktime = time.time() - benchmarktime
+    logging.info("Finished processing " + repr(totalrecords) + " records from " +
+                 repr(sum(len(logfiles) for logfiles in finished.values())) + " files in " + repr(benchmarktime) +
+                 " seconds at " + repr(totalrecords / benchmarktime) + " records per second.")
+    if failed:
+        sys.exit(1)
+
+
+def serve(args, whitelists):
+    # runs until signalled, ingesting each finished file under the watched directories with one open
+    # writer per log type
+    watcher = watch.create_watcher(args.filename, args.poll_interval)
+
+    def stop(signum, frame):
+        logging.info("received signal " + str(signum) + ", stopping after the current file")
+        watcher.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    writers = {}
+    logging.info("watching " + " ".join(args.filename) + " for new logs")
+    for logfile in watcher.watch():
+        ingest_file(writers, logfile, args, whitelists)
+
+    for writer in writers.values():
+        writer.close()
+    logging.info("stopped watching for new logs")
+
+
+def ingest_file(writers, logfile, args, whitelists):
+    # parses and commits a single file with the open writer of its log type, opening one when there is none
+    # yet.  used by the daemon and by brocess_collect.py for files as they arrive
+    logtype = get_logtype(os.path.split(logfile)[1], args)
+    if not logtype:
+        return None
+    if logtype not in writers:
+        writers[logtype] = create_logprocess(logtype, args, whitelists)
+        writers[logtype].open()
+    writer = writers[logtype]
+    logging.info("parsing " + logfile)
+    benchmarktime = time.time()
+    try:
+        numrecords = writer.parse(logfile)
+        writer.sync()
+    except Exception:
+        logging.error("Unable to process " + logfile + ": " + traceback.format_exc())
+        writer.discard()
+        return None
+    benchmarktime = time.time() - benchmarktime
+    logging.info("Finished processing " + repr(numrecords) + " records in " + repr(benchmarktime) + " seconds")
+    if args.options.get("metrics_file"):
+        metrics.write_textfile(args.options["metrics_file"])
+    if args.remove:
+        try:
+            os.remove(logfile)
+        except:
+            logging.critical("Unable to remove file: " + logfile)
+    return numrecords
+
+
+def start_metrics(options):
+    # serves /metrics while running when metrics_port is set, and reports the metrics once brocess exits
+    if options.get("metrics_port"):
+        metrics.serve(int(options["metrics_port"]), options.get("metrics_address", ""))
+    atexit.register(report_metrics, options)
+
+
+def report_metrics(options):
+    if options.get("metrics_file"):
+        metrics.write_textfile(options["metrics_file"])
+    if options.get("metrics_json"):
+        metrics.write_summary(options["metrics_json"])
+    logging.info("metrics " + json.dumps(metrics.registry.summary(), sort_keys=True))
+
+
 def main():
     args = parser.parse_args()
     args, whitelists = reconcileINI(args)
@@ -263,37 +944,47 @@ def main():
     #else:
         #logging.basicConfig(format=args.logformatline, level=logging.DEBUG)
 
-    if not os.path.isfile(args.filename):
-        logging.critical("Cannot find: " + args.filename)
-        sys.exit(-1)
     if not args.connlog and not args.smtplog and not args.httplog:
         logging.critical("No watch filters (connlog or smtplog) are set.")
         sys.exit(-1)
-    filename = os.path.split(args.filename)[1]
-    logprocess = None
-    if args.connlog:
-        if fnmatch.fnmatch(filename, args.connlog):
-            logprocess = ConnLog(args.dbtype, args.database, whitelist_src_ips=whitelists["conn_src_whitelist_ips"],
-                                 whitelist_dest_ips=whitelists["conn_dest_whitelist_ips"],
-                                 whitelist_dest_ports=whitelists["conn_dest_whitelist_ports"])
-    if args.smtplog:
-        if fnmatch.fnmatch(filename, args.smtplog):
-            logprocess = SMTPLog(args.dbtype, args.database, whitelist_source=whitelists["smtp_whitelist_source"],
-                                 whitelist_destination=whitelists["smtp_whitelist_destination"])
-    if args.httplog:
-        if fnmatch.fnmatch(filename, args.httplog):
-            logprocess = HTTPLog(args.dbtype, args.database)
+    whitelists = whitelist.compile_whitelists(whitelists)
+    start_metrics(args.options)
+    if args.daemon:
+        for path in args.filename:
+            if not os.path.isdir(path):
+                logging.critical("Cannot watch " + path + ": not a directory")
+                sys.exit(-1)
+        serve(args, whitelists)
+        return
+    if len(args.filename) > 1 or not os.path.isfile(args.filename[0]):
+        logfiles = find_logfiles(args.filename)
+        if not logfiles and all(os.path.isdir(path) for path in args.filename):
+            # a sensor directory with no new logs since the last run
+            logging.info("No logs in " + " ".join(args.filename) + ", nothing to do")
+            return
+        if not logfiles:
+            logging.critical("Cannot find: " + " ".join(args.filename))
+            sys.exit(-1)
+        ingest(logfiles, args, whitelists)
+        return
+
+    filepath = args.filename[0]
+    filename = os.path.split(filepath)[1]
+    logprocess = create_logprocess(get_logtype(filename, args), args, whitelists)
     if not logprocess:
         logging.critical("Unable to find a pattern match for " + filename)
         sys.exit(-1)
-    runtime, numrecords, benchmark = logprocess.start(args.filename)
-    logging.info("Finished processing " + repr(numrecords) + " records in " + repr(runtime) + " seconds at " + repr(
-        benchmark) + " records per second.")
+    logprocess.open()
+    result = logprocess.start(filepath)
+    if result:
+        runtime, numrecords, benchmark = result
+        logging.info("Finished processing " + repr(numrecords) + " records in " + repr(runtime) + " seconds at " +
+                     repr(benchmark) + " records per second.")
     if args.remove:
         try:
-            os.remove(args.filename)
+            os.remove(filepath)
         except:
-            logging.critical("Unable to remove file: " + args.filename)
+            logging.critical("Unable to remove file: " + filepath)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+
+import argparse
+import configparser
+import logging
+import os
+import sys
+
+from collect import DEFAULT_EXCLUDE, DEFAULT_PATTERNS, Collector, LocalSource, Manifest, SSHSource
+
+parser = argparse.ArgumentParser(
+    description="Pull new, complete bro logs from sensors into a local directory per sensor.  Every file "
+                "transferred is kept in a manifest, so only files a sensor has that were never pulled before, or "
+                "have changed since, are transferred.")
+parser.add_argument('sources', nargs='+',
+                    help="Sensors to pull from: a host or user@host reached over ssh, or name=directory for a "
+                         "local directory standing in for a sensor.")
+parser.add_argument('-i', help="Path to configuration file. Defaults to brocess.ini")
+parser.add_argument('--destination', help="Directory the files of each sensor are written under. Defaults to data")
+parser.add_argument('--manifest', help="Path to the sqlite manifest of transferred files. "
+                                       "Defaults to manifest.db in the destination.")
+parser.add_argument('-j', '--concurrency', type=int, help="Transfers running at once overall. Defaults to 8")
+parser.add_argument('--host-concurrency', type=int, dest='host_concurrency',
+                    help="Transfers running at once from one sensor. Defaults to 2")
+parser.add_argument('--min-age', type=float, dest='min_age',
+                    help="Seconds since a file was last written before it is pulled. Defaults to 60")
+parser.add_argument('--ingest', action='store_true',
+                    help="Parse each file into the database configured in the ini file as soon as it arrives.")
+parser.add_argument('-r', '--remove', action='store_true',
+                    help="With --ingest, remove each file once it has been ingested.  The manifest keeps it from "
+                         "being pulled again.")
+args = parser.parse_args()
+
+inifile = 'brocess.ini' if not args.i else args.i
+config = configparser.ConfigParser()
+config.read(inifile)
+logging.basicConfig(format="[%(asctime)s] [%(threadName)s] [%(levelname)s] - %(message)s", level=logging.INFO)
+
+
+def option(name, value, fallback, convert=str):
+    if value is not None:
+        return value
+    return convert(config.get("collect", name, fallback=fallback))
+
+
+def patterns(name, fallback):
+    if not config.get("collect", name, fallback=None):
+        return fallback
+    return tuple(pattern.strip() for pattern in config.get("collect", name).split(",") if pattern.strip())
+
+
+destination = option("destination", args.destination, "data")
+root = config.get("collect", "root", fallback="/nsm/bro/logs")
+user = config.get("collect", "user", fallback=None)
+ssh = config.get("collect", "ssh", fallback="ssh")
+
+sources = []
+for spec in args.sources:
+    if "=" in spec:
+        name, directory = spec.split("=", 1)
+        if not os.path.isdir(directory):
+            logging.critical("Cannot collect from " + directory + ": not a directory")
+            sys.exit(-1)
+        sources.append(LocalSource(name, directory))
+    elif "@" in spec:
+        sources.append(SSHSource(spec.split("@", 1)[1], root, user=spec.split("@", 1)[0], ssh=ssh))
+    else:
+        sources.append(SSHSource(spec, root, user=user, ssh=ssh))
+
+os.makedirs(destination, exist_ok=True)
+manifest = Manifest(option("manifest", args.manifest, os.path.join(destination, "manifest.db")))
+collector = Collector(manifest, destination,
+                      patterns=patterns("patterns", DEFAULT_PATTERNS),
+                      exclude=patterns("exclude", DEFAULT_EXCLUDE),
+                      host_concurrency=option("host_concurrency", args.host_concurrency, 2, int),
+                      concurrency=option("concurrency", args.concurrency, 8, int),
+                      min_age=option("min_age", args.min_age, 60, float))
+
+# with --ingest, files are handed to the brocess writers one at a time as their transfers complete, while the
+# remaining transfers carry on
+writers = {}
+if args.ingest:
+    import brocess
+    import whitelist
+    brocessargs = brocess.parser.parse_args(["-i", inifile] + (["-r"] if args.remove else []) + [destination])
+    brocessargs, whitelists = brocess.reconcileINI(brocessargs)
+    whitelists = whitelist.compile_whitelists(whitelists)
+
+transferred = 0
+for name, localpath in collector.collect(sources):
+    transferred += 1
+    if args.ingest:
+        brocess.ingest_file(writers, localpath, brocessargs, whitelists)
+
+for writer in writers.values():
+    writer.close()
+manifest.close()
+logging.info("transferred " + str(transferred) + " files from " + str(len(sources)) + " sensors")
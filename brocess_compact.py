@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+#
+
+import argparse
+import configparser
+import datetime
+import sys
+
+parser = argparse.ArgumentParser(description="Remove expired days from the daily rollup tables.")
+parser.add_argument('-i', help="Path to configuration file. Defaults to brocess.ini")
+parser.add_argument('-t', '--dbtype', help="The type of database to use. Defaults to the dbtype in the configuration.")
+parser.add_argument('-d', '--database', help="The database connection string to use. Defaults to the configuration.")
+parser.add_argument('--days', type=int,
+                    help="Number of days of rollups kept. Defaults to rollup_retention_days, or 90 when unset.")
+args = parser.parse_args()
+
+config = configparser.ConfigParser()
+config.read('brocess.ini' if not args.i else args.i)
+
+dbtype = args.dbtype if args.dbtype else config.get("main", "dbtype")
+database = args.database if args.database else config.get(dbtype, "database")
+days = args.days if args.days is not None else config.getint("main", "rollup_retention_days", fallback=90)
+
+dbe = __import__(dbtype + "db")
+dbengine = dbe.DBEngine(database, dict(config[dbtype]) if dbtype in config else {})
+if not dbengine.open():
+    print("could not connect to database {}".format(database))
+    sys.exit(1)
+db = dbe.LogDB(dbengine)
+if not db.instantiate():
+    print("unable to use database {} with this version of brocess".format(database))
+    sys.exit(1)
+
+# every count in the rollups is already part of the lifetime tables, so expired days are simply dropped
+before = (datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=days)).isoformat()
+print("removed {} rollup rows from before {}".format(db.compact_rollups(before), before))
+db.close()
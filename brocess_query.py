@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+
+import argparse
+import configparser
+import logging
+import sys
+
+from query import Query, open_logdb
+
+# the lookup used for each kind of key, and the number of tab separated fields a key has
+KINDS = {
+    "http": (lambda query, keys: query.hosts(key[0] for key in keys), 1),
+    "smtp": (lambda query, keys: query.email_pairs(keys), 2),
+    "conn": (lambda query, keys: query.connections(keys), 3),
+    "connerr": (lambda query, keys: query.connections(keys, errors=True), 3),
+}
+
+parser = argparse.ArgumentParser(
+    description="Look up how often keys have been seen and when they were first seen.  Keys are given as "
+                "arguments or read from stdin, one per line, as tab separated fields: a host, a mailfrom and "
+                "rcptto pair, or a source address, destination address and port.  Each key is printed back with "
+                "its count and first seen time, or - when it has never been seen.")
+parser.add_argument('kind', choices=sorted(KINDS), help="The table to look the keys up in.")
+parser.add_argument('keys', nargs='*', help="Keys to look up. Read from stdin when none are given.")
+parser.add_argument('-i', help="Path to configuration file. Defaults to brocess.ini")
+parser.add_argument('-t', '--dbtype', help="The type of database to use. Defaults to the dbtype in the configuration.")
+parser.add_argument('-d', '--database', help="The database connection string to use. Defaults to the configuration.")
+parser.add_argument('-n', '--batch-size', type=int, default=1000, dest='batch_size',
+                    help="Number of keys read from stdin and looked up at a time. Defaults to 1000")
+args = parser.parse_args()
+
+config = configparser.ConfigParser()
+config.read('brocess.ini' if not args.i else args.i)
+logging.basicConfig(format="[%(levelname)s] - %(message)s", level=logging.WARNING)
+
+dbtype = args.dbtype if args.dbtype else config.get("main", "dbtype")
+database = args.database if args.database else config.get(dbtype, "database")
+db = open_logdb(dbtype, database, dict(config[dbtype]) if dbtype in config else {})
+query = Query(db, cache_size=config.getint("main", "query_cache_size", fallback=100000),
+              cache_ttl=config.getfloat("main", "query_cache_ttl", fallback=300))
+lookup, numfields = KINDS[args.kind]
+
+
+def lookup_batch(lines):
+    keys = []
+    for line in lines:
+        key = tuple(field.strip() for field in line.split("\t"))
+        if len(key) != numfields:
+            logging.error("expected {} fields, skipping: {}".format(numfields, line))
+            continue
+        keys.append(key)
+    results = lookup(query, keys)
+    for key in keys:
+        result = results[key[0] if args.kind == "http" else key]
+        sys.stdout.write("\t".join(key + ((str(result[0]), repr(result[1])) if result else ("-", "-"))) + "\n")
+    sys.stdout.flush()
+
+
+if args.keys:
+    lookup_batch(args.keys)
+else:
+    lines = []
+    for line in sys.stdin:
+        line = line.rstrip("\n")
+        if not line:
+            continue
+        lines.append(line)
+        if len(lines) >= args.batch_size:
+            lookup_batch(lines)
+            lines = []
+    if lines:
+        lookup_batch(lines)
+
+db.close()
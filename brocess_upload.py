@@ -5,10 +5,32 @@ import argparse
 import configparser
 import pymysql
 import sqlite3
+import sys
+import uuid
+
+# the key columns of every table a LogDB writes.  the daily rollup tables also keep the last time a key was seen
+TABLES = {
+    "connlog": ("sourceip", "destip", "destport"),
+    "connerr": ("sourceip", "destip", "destport"),
+    "smtplog": ("source", "destination"),
+    "httplog": ("host",),
+    "connlog_daily": ("day", "sourceip", "destip", "destport"),
+    "connerr_daily": ("day", "sourceip", "destip", "destport"),
+    "smtplog_daily": ("day", "source", "destination"),
+    "httplog_daily": ("day", "host"),
+}
 
 parser = argparse.ArgumentParser(description="Transfer local sqlite3 database to mysql database.")
 parser.add_argument('sqlitedb', help="Path to the sqlite database to load.")
 parser.add_argument('-i', help="Path to configuration file. Defaults to brocess.ini")
+parser.add_argument('-n', '--chunk-size', type=int, default=5000, dest='chunk_size',
+                    help="Number of rows read and written at a time. Defaults to 5000")
+parser.add_argument('-t', '--table', action='append', dest='tables', choices=sorted(TABLES),
+                    help="Table to transfer, may be given more than once. Defaults to every table.")
+parser.add_argument('--name', help="Name the transfer checkpoint is kept under. Defaults to an id stored in the sqlite "
+                                   "database the first time it is transferred.")
+parser.add_argument('--restart', action='store_true',
+                    help="Ignore the checkpoint of a previous transfer and start from the first row.")
 args = parser.parse_args()
 
 source_connection = sqlite3.connect(args.sqlitedb)
@@ -20,20 +42,77 @@ config.read('brocess.ini' if not args.i else args.i)
 dest_connection = pymysql.connect(host=config['mysqli']['server'], user=config['mysqli']['username'],
                                   password=config['mysqli']['password'], db=config['mysqli']['database'])
 dest_cursor = dest_connection.cursor()
-counter = 0
-limit = 1000
+
+
+def database_id():
+    # a random id kept in the properties table, so a staging database recreated at the same path is not taken
+    # for one already transferred
+    source_cursor.execute("create table if not exists properties (label TEXT UNIQUE,value TEXT)")
+    source_cursor.execute("insert or ignore into properties (label,value) values (?,?)",
+                          ("UPLOAD_ID", uuid.uuid4().hex))
+    source_connection.commit()
+    source_cursor.execute("select value from properties where label=?", ("UPLOAD_ID",))
+    return source_cursor.fetchone()[0]
+
+
+# the last sqlite rowid transferred for each table is committed together with the rows it covers and the
+# total count of the rows up to it, so an interrupted transfer resumes where it stopped without counting
+# anything twice.  rows are read in rowid order, so a row updated in place after it was transferred would be
+# missed; the total tells when that happened
+name = args.name if args.name else database_id()
+dest_cursor.execute("create table if not exists upload_checkpoints (source varchar(255) not null, "
+                    "tablename varchar(64) not null, lastrowid bigint not null, numconnections bigint not null, "
+                    "PRIMARY KEY(source,tablename))")
+dest_connection.commit()
+
 total = 0
-source_cursor.execute("SELECT host, numconnections, firstconnectdate FROM httplog")
-for host, numconnections, firstconnectdate in source_cursor:
-    dest_cursor.execute("""insert into httplog (host,numconnections,firstconnectdate) values (%s,%s,%s)
-                           on duplicate key update numconnections = numconnections + %s""", (host, numconnections, firstconnectdate, numconnections))
-    counter += 1
-    total += 1
-    if counter >= limit:
+for table in (args.tables if args.tables else sorted(TABLES)):
+    source_cursor.execute("select count(*) from sqlite_master where type='table' and name=?", (table,))
+    if not source_cursor.fetchone()[0]:
+        continue
+
+    lastrowid = 0
+    numconnections = 0
+    if not args.restart:
+        dest_cursor.execute("select lastrowid,numconnections from upload_checkpoints where source=%s and tablename=%s",
+                            (name, table))
+        result = dest_cursor.fetchone()
+        if result:
+            lastrowid, numconnections = result
+            source_cursor.execute("select coalesce(sum(numconnections),0) from {} where rowid <= ?".format(table),
+                                  (lastrowid,))
+            if source_cursor.fetchone()[0] != numconnections:
+                print("{} in {} has changed since it was last transferred, refusing to transfer it again".format(
+                      table, args.sqlitedb))
+                sys.exit(1)
+
+    columns = TABLES[table] + ("numconnections", "firstconnectdate")
+    insert = "insert into {} ({}) values ".format(table, ",".join(columns))
+    upsert = (" on duplicate key update numconnections=numconnections+values(numconnections),"
+              "firstconnectdate=least(firstconnectdate,values(firstconnectdate))")
+    if table.endswith("_daily"):
+        columns += ("lastconnectdate",)
+        upsert += ",lastconnectdate=greatest(lastconnectdate,values(lastconnectdate))"
+    transferred = 0
+    source_cursor.execute("select rowid,{} from {} where rowid > ? order by rowid".format(",".join(columns), table),
+                          (lastrowid,))
+    while True:
+        rows = source_cursor.fetchmany(args.chunk_size)
+        if not rows:
+            break
+        values = ",".join("(" + ",".join(dest_connection.literal(value) for value in row[1:]) + ")" for row in rows)
+        dest_cursor.execute(insert + values + upsert)
+        numconnections += sum(row[len(TABLES[table]) + 1] for row in rows)
+        dest_cursor.execute("insert into upload_checkpoints (source,tablename,lastrowid,numconnections) "
+                            "values (%s,%s,%s,%s) on duplicate key update lastrowid=values(lastrowid),"
+                            "numconnections=values(numconnections)", (name, table, rows[-1][0], numconnections))
         dest_connection.commit()
-        counter = 0
+        transferred += len(rows)
+
+    print("transfered {} entries from {}".format(transferred, table))
+    total += transferred
 
-dest_connection.commit()
 dest_connection.close()
+source_connection.close()
 
 print("transfered {} entries".format(total))
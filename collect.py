@@ -0,0 +1,192 @@
+import concurrent.futures
+import fnmatch
+import logging
+import os
+import posixpath
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+
+from ledger import file_identity
+
+# the logs pulled from a sensor, relative to its log directory.  conn logs are left on the sensors for now
+DEFAULT_PATTERNS = ("*/http.*.log.gz", "*/smtp.*.log.gz")
+# bro is still writing the logs under current
+DEFAULT_EXCLUDE = ("current/*",)
+
+
+class Manifest(object):
+    # every file transferred from each host, keyed by its path on the host, with the size and mtime it had and
+    # the sha1 of what was received.  a host's listing is checked against it with indexed lookups, so the cost
+    # of a run follows what the host still has rather than everything ever collected
+    def __init__(self, path, chunk_size=250):
+        self.connection = sqlite3.connect(path)
+        self.chunk_size = chunk_size
+        self.connection.execute(
+            "create table if not exists transfers (host TEXT not null, path TEXT not null, size INTEGER, "
+            "mtime REAL, digest TEXT, localpath TEXT, transferred REAL, PRIMARY KEY(host,path))"
+        )
+        self.connection.commit()
+
+    def lookup(self, host, paths):
+        # returns {path: (size, mtime)} for those of paths already transferred from host
+        paths = list(paths)
+        results = {}
+        for i in range(0, len(paths), self.chunk_size):
+            chunk = paths[i:i + self.chunk_size]
+            cursor = self.connection.execute("select path,size,mtime from transfers where host=? and path in (" +
+                                             ",".join("?" for path in chunk) + ")", [host] + chunk)
+            for path, size, mtime in cursor:
+                results[path] = (size, mtime)
+        return results
+
+    def record(self, host, path, size, mtime, digest, localpath):
+        self.connection.execute(
+            "insert into transfers (host,path,size,mtime,digest,localpath,transferred) values (?,?,?,?,?,?,?) "
+            "on conflict(host,path) do update set size=excluded.size,mtime=excluded.mtime,digest=excluded.digest,"
+            "localpath=excluded.localpath,transferred=excluded.transferred",
+            (host, path, size, mtime, digest, localpath, time.time())
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class LocalSource(object):
+    # a directory on this machine standing in for a sensor, e.g. an nfs mount or a copy used for testing
+    def __init__(self, name, root):
+        self.name = name
+        self.root = root
+
+    def list(self):
+        # returns (path, size, mtime) of every file under root
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                files.append((os.path.relpath(filepath, self.root).replace(os.sep, "/"), st.st_size, st.st_mtime))
+        return files
+
+    def fetch(self, path, localpath):
+        shutil.copy2(os.path.join(self.root, path), localpath)
+
+
+class SSHSource(object):
+    # a sensor listed with find and copied from with rsync, both over ssh
+    def __init__(self, name, root, user=None, ssh="ssh"):
+        self.name = name
+        self.root = root
+        self.target = user + "@" + name if user else name
+        self.ssh = ssh
+
+    def list(self):
+        command = "find " + shlex.quote(self.root) + " -type f -name '*.log.gz' -printf '%P\\t%s\\t%T@\\n'"
+        output = subprocess.run(shlex.split(self.ssh) + [self.target, command], stdout=subprocess.PIPE,
+                                check=True).stdout.decode()
+        files = []
+        for line in output.splitlines():
+            path, size, mtime = line.split("\t")
+            files.append((path, int(size), float(mtime)))
+        return files
+
+    def fetch(self, path, localpath):
+        subprocess.run(["rsync", "--times", "--protect-args", "-e", self.ssh,
+                        self.target + ":" + posixpath.join(self.root, path), localpath], check=True)
+
+
+class Collector(object):
+    # pulls the complete files a set of sources have that are not in the manifest, with at most
+    # host_concurrency transfers from one source and concurrency transfers overall
+    def __init__(self, manifest, destination, patterns=DEFAULT_PATTERNS, exclude=DEFAULT_EXCLUDE,
+                 host_concurrency=2, concurrency=8, min_age=60):
+        self.manifest = manifest
+        self.destination = destination
+        self.patterns = patterns
+        self.exclude = exclude
+        self.host_concurrency = host_concurrency
+        self.concurrency = concurrency
+        # seconds since a file was last modified before it is considered complete
+        self.min_age = min_age
+        self.transfers = threading.BoundedSemaphore(concurrency)
+
+    def _wanted(self, path):
+        if any(fnmatch.fnmatch(path, pattern) for pattern in self.exclude):
+            return False
+        return any(fnmatch.fnmatch(path, pattern) for pattern in self.patterns)
+
+    def _list(self, source):
+        try:
+            return source.list()
+        except Exception as e:
+            logging.error("Unable to list the files on " + source.name + ": " + str(e))
+            return []
+
+    def pending(self, source, files):
+        # the files of source that are complete and have not been transferred with the same size and mtime
+        cutoff = time.time() - self.min_age
+        files = [(path, size, mtime) for path, size, mtime in files if mtime <= cutoff and self._wanted(path)]
+        known = self.manifest.lookup(source.name, [path for path, size, mtime in files])
+        return [(path, size, mtime) for path, size, mtime in files if known.get(path) != (size, mtime)]
+
+    def _fetch(self, source, path, size, mtime):
+        # transfers to a hidden partial file that is renamed into place once it is complete, so watchers and
+        # the log patterns never see it half written
+        localpath = os.path.join(self.destination, source.name, *path.split("/"))
+        directory, filename = os.path.split(localpath)
+        os.makedirs(directory, exist_ok=True)
+        partial = os.path.join(directory, "." + filename + ".part")
+        try:
+            with self.transfers:
+                source.fetch(path, partial)
+            if os.path.getsize(partial) != size:
+                raise IOError("changed while it was transferred")
+            digest = file_identity(partial)["digest"]
+            os.replace(partial, localpath)
+        except Exception:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return localpath, digest
+
+    def collect(self, sources):
+        # yields (source name, local path) of each new file as soon as it has been transferred and recorded in
+        # the manifest.  sources are listed and pulled from at the same time
+        with concurrent.futures.ThreadPoolExecutor(max(1, min(len(sources), self.concurrency))) as listing:
+            listed = list(listing.map(self._list, sources))
+
+        executors = []
+        futures = {}
+        try:
+            for source, files in zip(sources, listed):
+                pending = self.pending(source, files)
+                logging.info(source.name + " has " + str(len(pending)) + " new files")
+                if not pending:
+                    continue
+                executor = concurrent.futures.ThreadPoolExecutor(self.host_concurrency,
+                                                                 thread_name_prefix="collect-" + source.name)
+                executors.append(executor)
+                for path, size, mtime in pending:
+                    future = executor.submit(self._fetch, source, path, size, mtime)
+                    futures[future] = (source, path, size, mtime)
+
+            for future in concurrent.futures.as_completed(futures):
+                source, path, size, mtime = futures[future]
+                try:
+                    localpath, digest = future.result()
+                except Exception as e:
+                    logging.error("Unable to transfer " + path + " from " + source.name + ": " + str(e))
+                    continue
+                self.manifest.record(source.name, path, size, mtime, digest, localpath)
+                logging.debug("transferred " + path + " from " + source.name)
+                yield source.name, localpath
+        finally:
+            for executor in executors:
+                executor.shutdown(wait=True, cancel_futures=True)
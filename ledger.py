@@ -0,0 +1,19 @@
+import hashlib
+import os
+
+
+# files are identified by the sha1 of their (compressed) content, so a log that is renamed, copied to another
+# host or collected twice is still recognised, while path, size and mtime are kept to make the ledger readable
+
+
+def file_identity(filepath, chunk_size=1048576):
+    st = os.stat(filepath)
+    digest = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return {"digest": digest.hexdigest(), "path": os.path.abspath(filepath), "size": st.st_size,
+            "mtime": st.st_mtime, "lineoffset": 0, "complete": False}
@@ -0,0 +1,151 @@
+import bisect
+import http.server
+import json
+import os
+import threading
+
+# upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, float("inf"))
+
+HELP = {
+    "brocess_stage_seconds": ("histogram", "Seconds spent in each stage of processing a log file or a batch."),
+    "brocess_files_total": ("counter", "Log files parsed."),
+    "brocess_lines_total": ("counter", "Lines read from log files."),
+    "brocess_skipped_records_total": ("counter", "Records left out, by reason."),
+    "brocess_records_written_total": ("counter", "Aggregated records handed to the database."),
+    "brocess_write_retries_total": ("counter", "Batches written again after a retryable database error."),
+}
+
+
+class Registry(object):
+    # counters and histograms keyed by metric name and a sorted tuple of (label, value) pairs.  the writer
+    # thread records into the same registry as the parser, so changes are made under a lock
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            histogram[0][bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def take(self):
+        # hands over everything recorded so far, e.g. from a worker process to the parent, and starts over
+        with self.lock:
+            snapshot = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        counters, histograms = snapshot
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (buckets, total, count) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def text(self):
+        # the prometheus text exposition format
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), total, count))
+                                for key, (buckets, total, count) in self.histograms.items())
+        lines = []
+        described = set()
+        for (name, labels), value in counters:
+            _describe(lines, described, name)
+            lines.append(name + _labels(labels) + " " + repr(value))
+        for (name, labels), (buckets, total, count) in histograms:
+            _describe(lines, described, name)
+            cumulative = 0
+            for bound, n in zip(BUCKETS, buckets):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(name + "_bucket" + _labels(labels + (("le", le),)) + " " + str(cumulative))
+            lines.append(name + "_sum" + _labels(labels) + " " + repr(total))
+            lines.append(name + "_count" + _labels(labels) + " " + str(count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # counters and the count, total and mean of each histogram, keyed by series
+        with self.lock:
+            summary = {"counters": {}, "histograms": {}}
+            for (name, labels), value in sorted(self.counters.items()):
+                summary["counters"][name + _labels(labels)] = value
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                summary["histograms"][name + _labels(labels)] = {
+                    "count": count, "sum": round(total, 6), "mean": round(total / count, 6) if count else 0}
+        return summary
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(label + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                          for label, value in labels) + "}"
+
+
+def _describe(lines, described, name):
+    if name in described or name not in HELP:
+        return
+    described.add(name)
+    lines.append("# HELP " + name + " " + HELP[name][1])
+    lines.append("# TYPE " + name + " " + HELP[name][0])
+
+
+# the registry every part of brocess records into
+registry = Registry()
+
+
+def write_textfile(path):
+    # written next to its final name and renamed, for the node_exporter textfile collector
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(registry.text())
+    os.replace(tmp, path)
+
+
+def write_summary(path):
+    with open(path, "w") as f:
+        json.dump(registry.summary(), f, indent=2)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, address=""):
+    # serves /metrics from a background thread for as long as the process runs
+    server = http.server.ThreadingHTTPServer((address, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
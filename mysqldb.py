@@ -1,6 +1,7 @@
 import pymysql
 import logging
 import os
+import time
 
 
 class DBConnectStringError(Exception):
@@ -8,7 +9,7 @@ class DBConnectStringError(Exception):
 
 
 class DBEngine(object):
-    def __init__(self, connectstring):
+    def __init__(self, connectstring, options=None):
         parts = connectstring.split(";")
         connectvals = {}
         for part in parts:
@@ -22,21 +23,35 @@ class DBEngine(object):
         if "database" not in connectvals.keys() or "uid" not in connectvals.keys() or "pwd" not in connectvals.keys():
             raise DBConnectStringError
         self.connectvals = connectvals
+        self.options = options if options else {}
         self.connection = None
 
+    def _connect(self):
+        return pymysql.connect(
+            host=self.connectvals["server"],
+            user=self.connectvals["uid"],
+            password=self.connectvals["pwd"],
+            db=self.connectvals["database"]
+        )
+
     def open(self):
         if not self.connection:
             try:
-                self.connection = pymysql.connect(
-                    host=self.connectvals["server"],
-                    user=self.connectvals["uid"],
-                    password=self.connectvals["pwd"],
-                    db=self.connectvals["database"]
-                )
+                self.connection = self._connect()
             except:
                 return False
         return True
 
+    def reconnect(self):
+        # replaces a connection that may already be gone, raising the error when a new one cannot be made
+        connection, self.connection = self.connection, None
+        if connection:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        self.connection = self._connect()
+
     def close(self):
         if self.connection:
             self.connection.close()
@@ -55,15 +70,133 @@ class DBEngine(object):
 
 
 class LogDB(object):
+    # rows are buffered per table and written as multi-row upserts
+    tables = {
+        "connlog": ("insert into connlog (sourceip,destip,destport,numconnections,firstconnectdate) values ",
+                    "(%s,%s,%s,%s,%s)"),
+        "connerr": ("insert into connerr (sourceip,destip,destport,numconnections,firstconnectdate) values ",
+                    "(%s,%s,%s,%s,%s)"),
+        "smtplog": ("insert into smtplog (source,destination,numconnections,firstconnectdate) values ",
+                    "(%s,%s,%s,%s)"),
+        "httplog": ("insert into httplog (host,numconnections,firstconnectdate) values ",
+                    "(%s,%s,%s)"),
+        "connlog_daily": ("insert into connlog_daily (day,sourceip,destip,destport,numconnections,firstconnectdate,"
+                          "lastconnectdate) values ", "(%s,%s,%s,%s,%s,%s,%s)"),
+        "connerr_daily": ("insert into connerr_daily (day,sourceip,destip,destport,numconnections,firstconnectdate,"
+                          "lastconnectdate) values ", "(%s,%s,%s,%s,%s,%s,%s)"),
+        "smtplog_daily": ("insert into smtplog_daily (day,source,destination,numconnections,firstconnectdate,"
+                          "lastconnectdate) values ", "(%s,%s,%s,%s,%s,%s)"),
+        "httplog_daily": ("insert into httplog_daily (day,host,numconnections,firstconnectdate,lastconnectdate) values ",
+                          "(%s,%s,%s,%s,%s)"),
+    }
+    upsert = (" on duplicate key update numconnections=numconnections+values(numconnections),"
+              "firstconnectdate=least(firstconnectdate,values(firstconnectdate))")
+    # the key columns of each lifetime table, for lookups
+    key_columns = {
+        "connlog": ("sourceip", "destip", "destport"),
+        "connerr": ("sourceip", "destip", "destport"),
+        "smtplog": ("source", "destination"),
+        "httplog": ("host",),
+    }
+    # the per-day rollup tables also keep the latest timestamp seen on each day
+    rollup_tables = ("connlog_daily", "connerr_daily", "smtplog_daily", "httplog_daily")
+    rollup_upsert = upsert + ",lastconnectdate=greatest(lastconnectdate,values(lastconnectdate))"
+    # lock wait timeout, deadlock, can't connect, server has gone away and lost connection
+    retry_errors = (1205, 1213, 2003, 2006, 2013)
+    # seconds the ids of committed batches are kept for telling whether a retried batch went through
+    applied_batch_age = 7 * 86400
+
     def __init__(self, dbengine):
         self.dbengine = dbengine
-        self.version = "1.0"
+        self.version = "2.0"
+        self.batch_size = int(dbengine.options.get("batch_size", 1000))
+        self.batch_bytes = int(dbengine.options.get("batch_bytes", 1048576))
+        self.query_chunk_size = int(dbengine.options.get("query_chunk_size", 1000))
+        self.health_check_interval = float(dbengine.options.get("health_check_interval", 30))
+        self._last_used = time.time()
+        self._batches = {}
 
     def _getCursor(self):
         return self.dbengine.connection.cursor()
 
     def _commit(self):
         self.dbengine.connection.commit()
+        self._last_used = time.time()
+
+    def retryable(self, e):
+        # a batch that failed on one of these was rolled back and may be written again on a new connection
+        if isinstance(e, pymysql.err.InterfaceError):
+            return True
+        return isinstance(e, pymysql.err.OperationalError) and bool(e.args) and e.args[0] in self.retry_errors
+
+    def check(self):
+        # pings a connection that has been idle for health_check_interval seconds, reconnecting when it is gone
+        if time.time() - self._last_used >= self.health_check_interval:
+            self.dbengine.connection.ping(reconnect=True)
+            self._last_used = time.time()
+
+    def reconnect(self):
+        self.discard()
+        self.dbengine.reconnect()
+        self._last_used = time.time()
+
+    def batch_applied(self, batchid):
+        # whether the batch was committed, for a batch whose commit was cut off
+        cursor = self._getCursor()
+        cursor.execute("select count(*) from applied_batches where batchid=%s", (batchid,))
+        result = int(cursor.fetchone()[0])
+        self._commit()
+        return result > 0
+
+    def _queue(self, table, row):
+        values = self.tables[table][1] % tuple(self.dbengine.connection.literal(value) for value in row)
+        batch = self._batches.setdefault(table, [[], 0])
+        batch[0].append((row, values))
+        batch[1] += len(values) + 1
+        if len(batch[0]) >= self.batch_size or batch[1] >= self.batch_bytes:
+            self._flush_table(table)
+
+    def _flush_table(self, table):
+        batch = self._batches.pop(table, None)
+        if not batch or not batch[0]:
+            return
+        # writing keys in order keeps concurrent writers from deadlocking on each other's rows
+        rows = sorted(batch[0], key=lambda item: item[0])
+        try:
+            cursor = self._getCursor()
+            upsert = self.rollup_upsert if table in self.rollup_tables else self.upsert
+            cursor.execute(self.tables[table][0] + ",".join(values for row, values in rows) + upsert)
+            cursor.close()
+        except Exception as e:
+            logging.error("MYSQLDB: Error writing {} rows to {}: {}".format(len(rows), table, e))
+            raise
+
+    def flush(self, batchid=None):
+        # everything queued since the last flush, including ingest ledger updates, is committed as one
+        # transaction, along with the id of the batch when one is given
+        try:
+            for table in list(self._batches):
+                self._flush_table(table)
+            if batchid:
+                cursor = self._getCursor()
+                cursor.execute("insert into applied_batches (batchid,applied) values (%s,%s)", (batchid, time.time()))
+            self._commit()
+        except Exception:
+            self.discard()
+            raise
+
+    def discard(self):
+        # drops everything queued or written since the last commit.  a lost connection has been rolled back by
+        # the server already
+        self._batches = {}
+        try:
+            self.dbengine.connection.rollback()
+        except Exception as e:
+            logging.debug("MYSQLDB: Unable to roll back: {}".format(e))
+
+    def close(self):
+        self.flush()
+        self.dbengine.close()
 
     def _exists(self, tablename):
         cursor = self._getCursor()
@@ -99,6 +232,14 @@ class LogDB(object):
             return False
         return True
 
+    def check_version(self):
+        # for readers: only checks that brocess wrote this database in a version this one can read,
+        # without creating tables or expiring anything
+        if not self._exists("properties"):
+            logging.critical("Database has no properties table.  It has not been written by brocess.")
+            return False
+        return self._checkVersion()
+
     def instantiate(self):
         if not self._exists("properties"):
             self._create_properties()
@@ -107,12 +248,12 @@ class LogDB(object):
                 return False
         cursor = self._getCursor()
         cursor.execute(
-            "create table if not exists connlog (sourceip varchar(15) not null, destip varchar(15) not null, "
+            "create table if not exists connlog (sourceip varbinary(16) not null, destip varbinary(16) not null, "
             "destport INTEGER(11) not null, "
             "numconnections INTEGER(11), firstconnectdate DOUBLE, PRIMARY KEY(sourceip,destip,destport))"
         )
         cursor.execute(
-            "create table if not exists connerr (sourceip varchar(15) not null, destip varchar(15) not null, "
+            "create table if not exists connerr (sourceip varbinary(16) not null, destip varbinary(16) not null, "
             "destport INTEGER(11) not null, "
             "numconnections INTEGER(11), firstconnectdate DOUBLE, PRIMARY KEY(sourceip,destip,destport))"
         )
@@ -125,6 +266,42 @@ class LogDB(object):
             "create table if not exists httplog (host varchar(255) not null, numconnections integer(11),"
             "firstconnectdate DOUBLE, PRIMARY KEY(host))"
         )
+        cursor.execute(
+            "create table if not exists connlog_daily (day DATE not null, sourceip varbinary(16) not null, "
+            "destip varbinary(16) not null, destport INTEGER(11) not null, numconnections INTEGER(11), "
+            "firstconnectdate DOUBLE, lastconnectdate DOUBLE, PRIMARY KEY(day,sourceip,destip,destport), "
+            "KEY(sourceip,destip,destport))"
+        )
+        cursor.execute(
+            "create table if not exists connerr_daily (day DATE not null, sourceip varbinary(16) not null, "
+            "destip varbinary(16) not null, destport INTEGER(11) not null, numconnections INTEGER(11), "
+            "firstconnectdate DOUBLE, lastconnectdate DOUBLE, PRIMARY KEY(day,sourceip,destip,destport), "
+            "KEY(sourceip,destip,destport))"
+        )
+        cursor.execute(
+            "create table if not exists smtplog_daily (day DATE not null, source varchar(255) not null, "
+            "destination varchar(255) not null, numconnections integer(11), firstconnectdate DOUBLE, "
+            "lastconnectdate DOUBLE, PRIMARY KEY(day,source,destination), KEY(source,destination))"
+        )
+        cursor.execute(
+            "create table if not exists httplog_daily (day DATE not null, host varchar(255) not null, "
+            "numconnections integer(11), firstconnectdate DOUBLE, lastconnectdate DOUBLE, PRIMARY KEY(day,host), "
+            "KEY(host))"
+        )
+        cursor.execute("create table if not exists sketches (name varchar(64) not null, data longblob, PRIMARY KEY(name))")
+        # the sketch rows exist up front so that locking them serializes every writer updating the sketches
+        cursor.execute("insert ignore into sketches (name) values ('cms:connlog'),('cms:connerr')")
+        cursor.execute(
+            "create table if not exists conn_sources (sourceip varbinary(16) not null, registers blob, "
+            "destinations bigint, PRIMARY KEY(sourceip))"
+        )
+        cursor.execute(
+            "create table if not exists ingested_files (digest char(40) not null, path varchar(1024), size bigint, "
+            "mtime DOUBLE, lineoffset bigint, complete tinyint, updated DOUBLE, PRIMARY KEY(digest))"
+        )
+        cursor.execute("create table if not exists applied_batches (batchid char(32) not null, applied DOUBLE, "
+                       "PRIMARY KEY(batchid))")
+        cursor.execute("delete from applied_batches where applied < %s", (time.time() - self.applied_batch_age,))
         self._commit()
         cursor.close()
         return True
@@ -132,51 +309,120 @@ class LogDB(object):
     def destruct(self):
         self.dbengine._destruct()
 
-    def add_conn_record(self, data):
-        try:
-            cursor = self._getCursor()
-            if data["conn_state"] == "SF":
-                cursor.execute(
-                    "insert into connlog (sourceip,destip,destport,numconnections,firstconnectdate) values (%s,%s,%s,1,%s)"
-                    "on duplicate key update numconnections=numconnections+1",
-                    (data["id.orig_h"], data["id.resp_h"], data["id.resp_p"], data["ts"])
-                )
-            else:
-                cursor.execute(
-                    "insert into connerr (sourceip,destip,destport,numconnections,firstconnectdate) values (%s,%s,%s,1,%s)"
-                    "on duplicate key update numconnections=numconnections+1",
-                    (data["id.orig_h"], data["id.resp_h"], data["id.resp_p"], data["ts"])
-                )
-            self._commit()
-            cursor.close()
-        except:
-            logging.error("MYSQLDB: Error processing: " + repr(data))
-        return
+    def compact_rollups(self, before):
+        # drops the rollup rows of days before the given YYYY-MM-DD date.  the lifetime tables are updated in the
+        # same flush as the rollups, so they already count those days.  rows go in chunks to keep locks short
+        cursor = self._getCursor()
+        removed = 0
+        for table in self.rollup_tables:
+            while True:
+                cursor.execute("delete from " + table + " where day < %s limit 10000", (before,))
+                self._commit()
+                removed += cursor.rowcount
+                if cursor.rowcount < 10000:
+                    break
+        cursor.close()
+        return removed
 
-    def add_smtp_record(self, data):
-        try:
-            cursor = self._getCursor()
-            cursor.execute(
-                "insert into smtplog (source,destination,numconnections,firstconnectdate) "
-                "values (%s,%s,1,%s) on duplicate key update numconnections=numconnections+1",
-                (data["mailfrom"], data["rcptto"], data["ts"])
-            )
-            self._commit()
-            cursor.close()
-        except:
-            logging.error("MYSQLDB: Error processing: " + repr(data))
-        return
+    def get_ingested_file(self, digest):
+        # returns (lineoffset, complete) for a file recorded in the ingest ledger, or None
+        cursor = self._getCursor()
+        cursor.execute("select lineoffset,complete from ingested_files where digest=%s", (digest,))
+        result = cursor.fetchone()
+        cursor.close()
+        return result
 
-    def add_http_record(self, data):
-        try:
-            cursor = self._getCursor()
-            cursor.execute(
-                "insert into httplog (host,numconnections,firstconnectdate) values (%s,%s,%s) "
-                "on duplicate key update numconnections=numconnections+1",
-                (data["host"], 1, data["ts"])
-            )
-            self._commit()
-            cursor.close()
-        except:
-            logging.error("MYSQLDB: Error processing: " + repr(data))
-        return
+    def record_ingested_file(self, entry):
+        # written in the same transaction as the rows it accounts for and committed by the next flush()
+        cursor = self._getCursor()
+        cursor.execute(
+            "insert into ingested_files (digest,path,size,mtime,lineoffset,complete,updated) "
+            "values (%s,%s,%s,%s,%s,%s,%s) on duplicate key update path=values(path),"
+            "lineoffset=values(lineoffset),complete=values(complete),updated=values(updated)",
+            (entry["digest"], entry["path"], entry["size"], entry["mtime"], entry["lineoffset"],
+             1 if entry["complete"] else 0, time.time())
+        )
+        cursor.close()
+
+    def lookup(self, table, keys):
+        # returns {key: (numconnections, firstconnectdate)} for those of the given key tuples found in table,
+        # reading query_chunk_size keys per statement
+        columns = self.key_columns[table]
+        if len(columns) == 1:
+            match, template = columns[0] + " in (", "%s"
+        else:
+            match, template = "(" + ",".join(columns) + ") in (", "(" + ",".join("%s" for column in columns) + ")"
+        keys = list(keys)
+        results = {}
+        cursor = self._getCursor()
+        for i in range(0, len(keys), self.query_chunk_size):
+            chunk = keys[i:i + self.query_chunk_size]
+            cursor.execute("select " + ",".join(columns) + ",numconnections,firstconnectdate from " + table + " where " +
+                           match + ",".join(template for key in chunk) + ")", [value for key in chunk for value in key])
+            for row in cursor.fetchall():
+                results[tuple(row[:-2])] = (row[-2], row[-1])
+        # ends the read so a long running reader is not held to the snapshot of its first lookup
+        self._commit()
+        cursor.close()
+        return results
+
+    def load_sketch(self, name):
+        # read for update, so concurrent writers fold their batches into the sketches one after another
+        cursor = self._getCursor()
+        cursor.execute("select data from sketches where name=%s for update", (name,))
+        result = cursor.fetchone()
+        cursor.close()
+        return result[0] if result else None
+
+    def store_sketch(self, name, data):
+        cursor = self._getCursor()
+        cursor.execute("update sketches set data=%s where name=%s", (data, name))
+        cursor.close()
+
+    def load_source_sketches(self, sourceips):
+        # returns {sourceip: registers} for the sources that have a distinct destination sketch, read for update
+        sourceips = sorted(sourceips)
+        results = {}
+        cursor = self._getCursor()
+        for i in range(0, len(sourceips), self.query_chunk_size):
+            chunk = sourceips[i:i + self.query_chunk_size]
+            cursor.execute("select sourceip,registers from conn_sources where sourceip in (" +
+                           ",".join("%s" for sourceip in chunk) + ") for update", chunk)
+            for sourceip, registers in cursor.fetchall():
+                results[sourceip] = registers
+        cursor.close()
+        return results
+
+    def store_source_sketches(self, sketches):
+        # {sourceip: (registers, estimated distinct destinations)}
+        rows = sorted((sourceip, registers, destinations) for sourceip, (registers, destinations) in sketches.items())
+        cursor = self._getCursor()
+        for i in range(0, len(rows), self.query_chunk_size):
+            chunk = rows[i:i + self.query_chunk_size]
+            cursor.execute("insert into conn_sources (sourceip,registers,destinations) values " +
+                           ",".join("(%s,%s,%s)" for row in chunk) + " on duplicate key update "
+                           "registers=values(registers),destinations=values(destinations)",
+                           [value for row in chunk for value in row])
+        cursor.close()
+
+    def add_conn_record(self, data, count=1):
+        table = "connlog" if data["conn_state"] == "SF" else "connerr"
+        self._queue(table, (data["id.orig_h"], data["id.resp_h"], data["id.resp_p"], count, data["ts"]))
+
+    def add_smtp_record(self, data, count=1):
+        self._queue("smtplog", (data["mailfrom"], data["rcptto"], count, data["ts"]))
+
+    def add_http_record(self, data, count=1):
+        self._queue("httplog", (data["host"], count, data["ts"]))
+
+    def add_conn_rollup(self, data, count=1):
+        table = "connlog_daily" if data["conn_state"] == "SF" else "connerr_daily"
+        self._queue(table, (data["day"], data["id.orig_h"], data["id.resp_h"], data["id.resp_p"], count, data["ts"],
+                            data["last_ts"]))
+
+    def add_smtp_rollup(self, data, count=1):
+        self._queue("smtplog_daily", (data["day"], data["mailfrom"], data["rcptto"], count, data["ts"],
+                                      data["last_ts"]))
+
+    def add_http_rollup(self, data, count=1):
+        self._queue("httplog_daily", (data["day"], data["host"], count, data["ts"], data["last_ts"]))
@@ -0,0 +1,44 @@
+import logging
+
+
+class PublicSuffixList(object):
+    # rules in the format of https://publicsuffix.org/list/public_suffix_list.dat
+    # without a list, the last label of a longer name is taken for a TLD, while a host that is a single label
+    # (an intranet name such as wiki) is kept unless the list has it
+    def __init__(self):
+        self.rules = set()
+        self.wildcards = set()
+        self.exceptions = set()
+
+    @classmethod
+    def load(cls, path):
+        psl = cls()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("//"):
+                    continue
+                rule = line.split()[0].lower()
+                try:
+                    rule = rule.encode("idna").decode()
+                except UnicodeError:
+                    pass
+                if rule.startswith("!"):
+                    psl.exceptions.add(rule[1:])
+                elif rule.startswith("*."):
+                    psl.wildcards.add(rule[2:])
+                else:
+                    psl.rules.add(rule)
+        logging.info("loaded " + str(len(psl.rules) + len(psl.wildcards) + len(psl.exceptions)) +
+                     " public suffix rules from " + path)
+        return psl
+
+    def is_public_suffix(self, domain, whole=False):
+        # whole is set when domain is the entire host name rather than a suffix of a longer one
+        if domain in self.exceptions:
+            return False
+        if domain in self.rules:
+            return True
+        if "." not in domain:
+            return not self.rules and not whole
+        return domain.split(".", 1)[1] in self.wildcards
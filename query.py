@@ -0,0 +1,114 @@
+import collections
+import logging
+import sys
+import time
+
+from address import pack_address
+
+
+class TTLCache(object):
+    # keeps the maxsize most recently used entries, each for ttl seconds
+    def __init__(self, maxsize=100000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_many(self, keys):
+        # returns the cached values of keys and the list of keys that have to be looked up
+        now = time.monotonic()
+        found = {}
+        missing = []
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= now:
+                missing.append(key)
+                continue
+            self.entries.move_to_end(key)
+            found[key] = entry[1]
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+def _email(address):
+    # the same normalisation SMTPLog applies before counting
+    address = address.strip().lower()
+    if address.startswith("<"):
+        address = address[1:]
+    if address.endswith(">"):
+        address = address[:-1]
+    return address
+
+
+class Query(object):
+    # batched lookups of the lifetime counts, answered from the cache where possible and otherwise with one
+    # round-trip per chunk of keys.  each lookup returns {key: (numconnections, firstconnectdate)} for every
+    # key asked for, with None for a key that has never been seen
+    def __init__(self, db, cache_size=100000, cache_ttl=300):
+        self.db = db
+        self.cache = TTLCache(cache_size, cache_ttl)
+
+    def _lookup(self, table, keys):
+        # cached under (table, key) so the conn tables do not share entries
+        found, missing = self.cache.get_many([(table, key) for key in set(keys)])
+        results = dict((cached[1], value) for cached, value in found.items())
+        if missing:
+            rows = self.db.lookup(table, [cached[1] for cached in missing])
+            for cached in missing:
+                results[cached[1]] = rows.get(cached[1])
+                self.cache.put(cached, results[cached[1]])
+        return results
+
+    def hosts(self, hosts):
+        keys = dict((host, (host.strip().lower(),)) for host in hosts)
+        results = self._lookup("httplog", keys.values())
+        return dict((host, results[key]) for host, key in keys.items())
+
+    def email_pairs(self, pairs):
+        # (mailfrom, rcptto) pairs
+        keys = dict(((source, destination), (_email(source), _email(destination))) for source, destination in pairs)
+        results = self._lookup("smtplog", keys.values())
+        return dict((pair, results[key]) for pair, key in keys.items())
+
+    def connections(self, connections, errors=False):
+        # (source address, destination address, port) tuples, looked up in connlog or, with errors set, in the
+        # connerr table of connections that did not complete
+        keys = {}
+        for connection in connections:
+            sourceip, destip, port = connection
+            sourceip, destip = pack_address(sourceip), pack_address(destip)
+            try:
+                keys[connection] = (sourceip, destip, int(port)) if sourceip and destip else None
+            except ValueError:
+                keys[connection] = None
+        results = self._lookup("connerr" if errors else "connlog", [key for key in keys.values() if key])
+        return dict((connection, results[key] if key else None) for connection, key in keys.items())
+
+
+def open_logdb(dbtype, database, dboptions=None):
+    # opens the database brocess writes to for reading.  only its version is checked, instantiate() would
+    # create the tables and expire old batches
+    dbe = __import__(dbtype + "db")
+    dbengine = dbe.DBEngine(database, dboptions)
+    if not dbengine.open():
+        logging.critical("Could not connect to database: " + database)
+        sys.exit(-1)
+    db = dbe.LogDB(dbengine)
+    if not db.check_version():
+        logging.critical("Unable to use database " + database + " with this version of brocess")
+        sys.exit(-1)
+    return db
+
@@ -0,0 +1,110 @@
+import datetime
+import logging
+import operator
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
+
+# a reader turns the lines of one log file into tuples of the columns a LogProcess asked for, as the strings
+# bro writes in its tab separated format, whichever format the file is actually in
+
+
+class TSVReader(object):
+    # the tab separated format, described by #separator and #fields header lines
+    def __init__(self, columns):
+        self.columns = columns
+        self.props = {}
+        self.separator = None
+        self._numfields = 0
+        self._project = None
+
+    def process_header(self, line):
+        if line.startswith("#close"):
+            return
+        line = str(line)[1:]
+        if line.startswith("separator"):
+            label, value = line.split()
+            value = chr(int(value.replace("\\", "0"), 16))
+            self.separator = value.encode()
+        else:
+            label, value = line.split(self.props["separator"], 1)
+        if label not in ["fields", "types"]:
+            self.props[label] = value
+        else:
+            self.props[label] = value.split(self.props["separator"])
+        if label == "fields":
+            self._set_columns(self.props["fields"])
+        logging.debug("label " + label + "=" + str(self.props[label]))
+
+    def _set_columns(self, fields):
+        # turns the header into the positions of the columns this log type needs, once per file
+        missing = [column for column in self.columns if column not in fields]
+        if missing:
+            raise ValueError("log is missing required fields: " + ", ".join(missing))
+        self._numfields = len(fields)
+        getter = operator.itemgetter(*[fields.index(column) for column in self.columns])
+        if len(self.columns) == 1:
+            self._project = lambda elements: (getter(elements),)
+        else:
+            self._project = getter
+
+    def get_line_data(self, line):
+        elements = line.split(self.separator)
+        if len(elements) != self._numfields:
+            logging.error("ERROR processing line: " + line.decode(errors="replace"))
+            logging.error(
+                "Number of elements is: " + str(len(elements)) + ", should be: " + str(self._numfields))
+            return
+        return tuple(element.decode() for element in self._project(elements))
+
+
+def _json_value(value):
+    # unset fields are left out of json logs altogether, sets and vectors become arrays
+    if value is None:
+        return "-"
+    if isinstance(value, bool):
+        return "T" if value else "F"
+    if isinstance(value, list):
+        return ",".join(_json_value(element) for element in value) if value else "-"
+    return str(value)
+
+
+def _json_ts(value):
+    # epoch seconds by default, ISO 8601 strings when bro runs with json_timestamps=JSON::TS_ISO8601
+    if isinstance(value, str):
+        try:
+            return str(float(value))
+        except ValueError:
+            return str(datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+    return _json_value(value)
+
+
+class JSONReader(object):
+    # one json object per line, as written with LogAscii::use_json=T.  there are no header lines, and only the
+    # needed keys are picked out of each decoded record
+    def __init__(self, columns):
+        self.columns = columns
+        self.props = {}
+
+    def process_header(self, line):
+        logging.debug("ignoring header in json log: " + line)
+
+    def get_line_data(self, line):
+        try:
+            record = _loads(line)
+            return tuple(_json_ts(record.get(column)) if column == "ts" else _json_value(record.get(column))
+                         for column in self.columns)
+        except (ValueError, AttributeError):
+            logging.error("ERROR processing line: " + line.decode(errors="replace"))
+
+
+def detect_reader(line, columns):
+    # picks the reader for a file from its first line
+    if line.lstrip().startswith(b"{"):
+        return JSONReader(columns)
+    return TSVReader(columns)
@@ -0,0 +1,178 @@
+import bisect
+import hashlib
+import logging
+import re
+
+# options of the [shard] section that are not handed on to the backend of each shard
+SHARD_OPTIONS = ("backend", "database", "vnodes")
+
+
+def _point(value):
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "big")
+
+
+class DBEngine(object):
+    # several databases of one backend, given as connection strings separated by | or one per line, e.g.
+    # /data/brocess0.db|/data/brocess1.db or server=db1;database=brocess;uid=u;pwd=p|server=db2;...
+    def __init__(self, connectstring, options=None):
+        self.connectstring = connectstring
+        self.options = options if options else {}
+        self.backend = self.options.get("backend", "sqlite")
+        self.shards = [shard.strip() for shard in re.split(r"[|\n]", connectstring) if shard.strip()]
+        if not self.shards:
+            raise ValueError("no shards in " + repr(connectstring))
+        self.module = __import__(self.backend + "db")
+        shardoptions = dict((key, value) for key, value in self.options.items() if key not in SHARD_OPTIONS)
+        self.engines = [self.module.DBEngine(shard, shardoptions) for shard in self.shards]
+
+    def open(self):
+        for shard, engine in zip(self.shards, self.engines):
+            if not engine.open():
+                logging.critical("SHARDDB: Could not connect to shard " + shard)
+                return False
+        return True
+
+    def close(self):
+        for engine in self.engines:
+            engine.close()
+
+    def engine(self):
+        return "shard"
+
+
+class LogDB(object):
+    # routes every key to one shard on a consistent hash ring, so that adding a shard moves about 1/N of the
+    # keys, and fans lookups out to every shard.  the ingest ledger and the count-min sketches live on the
+    # first shard, which is committed last
+    def __init__(self, dbengine):
+        self.dbengine = dbengine
+        self.version = "2.0"
+        self.shards = [dbengine.module.LogDB(engine) for engine in dbengine.engines]
+        # points per shard on the ring, more spread the keys more evenly
+        vnodes = int(dbengine.options.get("vnodes", 160))
+        ring = sorted((_point((shard + "#" + str(i)).encode()), n)
+                      for n, shard in enumerate(dbengine.shards) for i in range(vnodes))
+        self._points = [point for point, n in ring]
+        self._owners = [n for point, n in ring]
+        # set after reconnecting, when a retried batch may already have been committed on some shards
+        self._check_applied = False
+
+    def _owner(self, *key):
+        # bytes are hashed as they are and anything else by its string form, so a port is routed the same
+        # whether it is written as "53" or looked up as 53
+        value = b"\0".join(part if isinstance(part, bytes) else str(part).encode() for part in key)
+        return self._owners[bisect.bisect(self._points, _point(value)) % len(self._points)]
+
+    def _shard(self, *key):
+        return self.shards[self._owner(*key)]
+
+    def flush(self, batchid=None):
+        # each shard commits on its own, the first one with the ledger after the rest.  a shard failing part
+        # way through leaves the shards before it committed, which skip the batch when it is retried
+        pending = self.shards[1:] + self.shards[:1]
+        check, self._check_applied = self._check_applied, False
+        while pending:
+            shard = pending.pop(0)
+            try:
+                if check and batchid and shard.batch_applied(batchid):
+                    shard.discard()
+                else:
+                    shard.flush(batchid)
+            except Exception:
+                for other in pending:
+                    other.discard()
+                raise
+
+    def discard(self):
+        for shard in self.shards:
+            shard.discard()
+
+    def retryable(self, e):
+        # every shard uses the same backend
+        return self.shards[0].retryable(e)
+
+    def check(self):
+        for shard in self.shards:
+            shard.check()
+
+    def reconnect(self):
+        for shard in self.shards:
+            shard.reconnect()
+        self._check_applied = True
+
+    def batch_applied(self, batchid):
+        return all(shard.batch_applied(batchid) for shard in self.shards)
+
+    def close(self):
+        self.flush()
+        for shard in self.shards:
+            shard.close()
+
+    def instantiate(self):
+        for shard, connectstring in zip(self.shards, self.dbengine.shards):
+            if not shard.instantiate():
+                logging.critical("SHARDDB: Unable to use shard " + connectstring)
+                return False
+        return True
+
+    def compact_rollups(self, before):
+        return sum(shard.compact_rollups(before) for shard in self.shards)
+
+    def get_ingested_file(self, digest):
+        return self.shards[0].get_ingested_file(digest)
+
+    def record_ingested_file(self, entry):
+        self.shards[0].record_ingested_file(entry)
+
+    def lookup(self, table, keys):
+        # every shard is asked, so keys written before a shard was added are still found, and the counts of a
+        # key found on more than one shard are added up
+        keys = list(keys)
+        results = {}
+        for shard in self.shards:
+            for key, (count, first) in shard.lookup(table, keys).items():
+                if key in results:
+                    count, first = results[key][0] + count, min(results[key][1], first)
+                results[key] = (count, first)
+        return results
+
+    def load_sketch(self, name):
+        return self.shards[0].load_sketch(name)
+
+    def store_sketch(self, name, data):
+        self.shards[0].store_sketch(name, data)
+
+    def load_source_sketches(self, sourceips):
+        results = {}
+        for shard, chunk in self._group(sourceips).items():
+            results.update(self.shards[shard].load_source_sketches(chunk))
+        return results
+
+    def store_source_sketches(self, sketches):
+        for shard, chunk in self._group(sketches).items():
+            self.shards[shard].store_source_sketches(dict((sourceip, sketches[sourceip]) for sourceip in chunk))
+
+    def _group(self, sourceips):
+        groups = {}
+        for sourceip in sourceips:
+            groups.setdefault(self._owner(sourceip), []).append(sourceip)
+        return groups
+
+    def add_conn_record(self, data, count=1):
+        self._shard(data["id.orig_h"], data["id.resp_h"], data["id.resp_p"]).add_conn_record(data, count)
+
+    def add_smtp_record(self, data, count=1):
+        self._shard(data["mailfrom"], data["rcptto"]).add_smtp_record(data, count)
+
+    def add_http_record(self, data, count=1):
+        self._shard(data["host"]).add_http_record(data, count)
+
+    # rollups go to the shard of their key, next to its lifetime row
+    def add_conn_rollup(self, data, count=1):
+        self._shard(data["id.orig_h"], data["id.resp_h"], data["id.resp_p"]).add_conn_rollup(data, count)
+
+    def add_smtp_rollup(self, data, count=1):
+        self._shard(data["mailfrom"], data["rcptto"]).add_smtp_rollup(data, count)
+
+    def add_http_rollup(self, data, count=1):
+        self._shard(data["host"]).add_http_rollup(data, count)
@@ -0,0 +1,122 @@
+import array
+import hashlib
+import math
+import struct
+
+from address import unpack_address
+
+
+def _hash(value, size=8):
+    return int.from_bytes(hashlib.blake2b(value, digest_size=size).digest(), "big")
+
+
+class CountMinSketch(object):
+    # depth rows of width counters.  a key increments one counter per row and its count is estimated by the
+    # smallest of them, which is never below the true count and above it by at most e/width of the total
+    def __init__(self, width=32768, depth=4, counters=None):
+        self.width = width
+        self.depth = depth
+        self.counters = counters if counters is not None else array.array("Q", bytes(8 * width * depth))
+
+    def _cells(self, key):
+        h = _hash(key, 16)
+        h1, h2 = h >> 64, h & 0xffffffffffffffff
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        # returns the estimated count of key including this one
+        estimate = None
+        for cell in self._cells(key):
+            self.counters[cell] += count
+            if estimate is None or self.counters[cell] < estimate:
+                estimate = self.counters[cell]
+        return estimate
+
+    def estimate(self, key):
+        return min(self.counters[cell] for cell in self._cells(key))
+
+    def to_bytes(self):
+        return struct.pack("<II", self.width, self.depth) + self.counters.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        width, depth = struct.unpack_from("<II", data)
+        counters = array.array("Q")
+        counters.frombytes(data[8:])
+        return cls(width, depth, counters)
+
+
+class HyperLogLog(object):
+    # estimates the number of distinct values added with 2**precision one byte registers, to within about
+    # 1.04 / sqrt(2**precision)
+    def __init__(self, precision=10, registers=None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        h = _hash(value)
+        bits = 64 - self.precision
+        i = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def count(self):
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0], bytearray(data[1:]))
+
+
+class ConnSketch(object):
+    # approximate counting for connlog and connerr.  every connection counts towards a count-min sketch per
+    # table and a HyperLogLog of distinct destinations per source, both kept in the database, while exact rows
+    # are only written for keys estimated at threshold or more connections and for watched addresses
+    def __init__(self, threshold=100, width=32768, depth=4, precision=10, watchlist=()):
+        self.threshold = threshold
+        self.width = width
+        self.depth = depth
+        self.precision = precision
+        self.watchlist = watchlist
+
+    def update(self, db, items):
+        # folds a batch of aggregated conn records into the stored sketches, as part of the transaction the
+        # batch is written in, and returns the records to write exactly.  a key that crosses the threshold
+        # is written with its estimated count so its row starts from everything seen so far
+        sketches = {}
+        for table in ("connlog", "connerr"):
+            data = db.load_sketch("cms:" + table)
+            sketches[table] = CountMinSketch.from_bytes(data) if data else CountMinSketch(self.width, self.depth)
+        sources = {}
+        for sourceip, data in db.load_source_sketches(set(data["id.orig_h"] for data, count in items)).items():
+            sources[sourceip] = HyperLogLog.from_bytes(data)
+
+        exact = []
+        for data, count in items:
+            sourceip, destip = data["id.orig_h"], data["id.resp_h"]
+            hll = sources.get(sourceip)
+            if hll is None:
+                hll = sources[sourceip] = HyperLogLog(self.precision)
+            hll.add(destip)
+            key = bytes([len(sourceip)]) + sourceip + destip + data["id.resp_p"].encode()
+            estimate = sketches["connlog" if data["conn_state"] == "SF" else "connerr"].add(key, count)
+            if estimate - count >= self.threshold:
+                exact.append((data, count))
+            elif estimate >= self.threshold:
+                exact.append((data, estimate))
+            elif unpack_address(sourceip) in self.watchlist or unpack_address(destip) in self.watchlist:
+                exact.append((data, count))
+
+        for table, sketch in sketches.items():
+            db.store_sketch("cms:" + table, sketch.to_bytes())
+        db.store_source_sketches(dict((sourceip, (hll.to_bytes(), hll.count())) for sourceip, hll in sources.items()))
+        return exact
@@ -1,21 +1,44 @@
 import sqlite3
 import logging
 import os
+import time
 
 
 class DBEngine(object):
-    def __init__(self, connectstring):
+    # PRAGMAs that may be set from the [sqlite] section of the ini file
+    pragmas = ("journal_mode", "synchronous", "cache_size", "temp_store", "mmap_size")
+
+    def __init__(self, connectstring, options=None):
         self.connectstring = connectstring
+        self.options = options if options else {}
         self.connection = None
 
+    def _connect(self):
+        # the connection may be handed to a writer thread, but is only ever used by one thread at a time
+        connection = sqlite3.connect(self.connectstring, check_same_thread=False)
+        for pragma in self.pragmas:
+            value = self.options.get(pragma)
+            if not value:
+                continue
+            if not value.lstrip("-").isalnum():
+                logging.error("Invalid value for sqlite pragma " + pragma + ": " + value)
+                continue
+            connection.execute("pragma " + pragma + "=" + value)
+        return connection
+
     def open(self):
         if not self.connection:
             try:
-                self.connection = sqlite3.connect(self.connectstring)
+                self.connection = self._connect()
             except:
                 return False
         return True
 
+    def reconnect(self):
+        if self.connection:
+            self.connection.close()
+        self.connection = self._connect()
+
     def close(self):
         if self.connection:
             self.connection.close()
@@ -32,11 +55,49 @@ class DBEngine(object):
 
 
 class LogDB(object):
+    # rows are buffered per table and written with executemany as single-statement upserts
+    tables = {
+        "connlog": "insert into connlog (sourceip,destip,destport,numconnections,firstconnectdate) "
+                   "values (?,?,?,?,?) on conflict(sourceip,destip,destport) do update set ",
+        "connerr": "insert into connerr (sourceip,destip,destport,numconnections,firstconnectdate) "
+                   "values (?,?,?,?,?) on conflict(sourceip,destip,destport) do update set ",
+        "smtplog": "insert into smtplog (source,destination,numconnections,firstconnectdate) "
+                   "values (?,?,?,?) on conflict(source,destination) do update set ",
+        "httplog": "insert into httplog (host,numconnections,firstconnectdate) "
+                   "values (?,?,?) on conflict(host) do update set ",
+        "connlog_daily": "insert into connlog_daily (day,sourceip,destip,destport,numconnections,firstconnectdate,"
+                         "lastconnectdate) values (?,?,?,?,?,?,?) on conflict(day,sourceip,destip,destport) "
+                         "do update set ",
+        "connerr_daily": "insert into connerr_daily (day,sourceip,destip,destport,numconnections,firstconnectdate,"
+                         "lastconnectdate) values (?,?,?,?,?,?,?) on conflict(day,sourceip,destip,destport) "
+                         "do update set ",
+        "smtplog_daily": "insert into smtplog_daily (day,source,destination,numconnections,firstconnectdate,"
+                         "lastconnectdate) values (?,?,?,?,?,?) on conflict(day,source,destination) do update set ",
+        "httplog_daily": "insert into httplog_daily (day,host,numconnections,firstconnectdate,lastconnectdate) "
+                         "values (?,?,?,?,?) on conflict(day,host) do update set ",
+    }
+    upsert = ("numconnections=numconnections+excluded.numconnections,"
+              "firstconnectdate=min(firstconnectdate,excluded.firstconnectdate)")
+    # the key columns of each lifetime table, for lookups
+    key_columns = {
+        "connlog": ("sourceip", "destip", "destport"),
+        "connerr": ("sourceip", "destip", "destport"),
+        "smtplog": ("source", "destination"),
+        "httplog": ("host",),
+    }
+    # the per-day rollup tables also keep the latest timestamp seen on each day
+    rollup_tables = ("connlog_daily", "connerr_daily", "smtplog_daily", "httplog_daily")
+    rollup_upsert = upsert + ",lastconnectdate=max(lastconnectdate,excluded.lastconnectdate)"
+    # seconds the ids of committed batches are kept for telling whether a retried batch went through
+    applied_batch_age = 7 * 86400
+
     def __init__(self, dbengine):
         self.dbengine = dbengine
-        self.version = "1.0"
-        self.commit_count = 0
-        self.commit_limit = 1000
+        self.version = "2.0"
+        self.batch_size = int(dbengine.options.get("batch_size", 10000))
+        # older sqlite builds allow no more than 999 parameters per statement
+        self.query_chunk_size = int(dbengine.options.get("query_chunk_size", 250))
+        self._batches = {}
 
     def _getCursor(self):
         if hasattr(self, '_cursor'):
@@ -46,15 +107,73 @@ class LogDB(object):
         return getattr(self, '_cursor')
 
     def close(self):
+        self.flush()
         self.dbengine.connection.commit()
         self.dbengine.connection.close()
         self.dbengine.connection = None
 
     def _commit(self):
-        self.commit_count += 1
-        if self.commit_count >= self.commit_limit:
-            self.dbengine.connection.commit()
-            self.commit_count = 0
+        self.dbengine.connection.commit()
+
+    def retryable(self, e):
+        # another writer holding the database for longer than the busy timeout
+        return isinstance(e, sqlite3.OperationalError) and ("locked" in str(e) or "busy" in str(e))
+
+    def check(self):
+        pass
+
+    def reconnect(self):
+        self.discard()
+        if hasattr(self, '_cursor'):
+            delattr(self, '_cursor')
+        self.dbengine.reconnect()
+
+    def batch_applied(self, batchid):
+        # whether the batch was committed, for a batch whose commit was cut off
+        cursor = self._getCursor()
+        cursor.execute("select count(*) from applied_batches where batchid=?", (batchid,))
+        return int(cursor.fetchone()[0]) > 0
+
+    def _queue(self, table, row):
+        batch = self._batches.setdefault(table, [])
+        batch.append(row)
+        if len(batch) >= self.batch_size:
+            self._flush_table(table)
+
+    def _flush_table(self, table):
+        rows = self._batches.pop(table, None)
+        if not rows:
+            return
+        rows.sort()
+        try:
+            cursor = self._getCursor()
+            upsert = self.rollup_upsert if table in self.rollup_tables else self.upsert
+            cursor.executemany(self.tables[table] + upsert, rows)
+        except Exception as e:
+            logging.error("SQLITEDB: Error writing {} rows to {}: {}".format(len(rows), table, e))
+            raise
+
+    def flush(self, batchid=None):
+        # everything queued since the last flush, including ingest ledger updates, is committed as one
+        # transaction, along with the id of the batch when one is given
+        try:
+            for table in list(self._batches):
+                self._flush_table(table)
+            if batchid:
+                cursor = self._getCursor()
+                cursor.execute("insert into applied_batches (batchid,applied) values (?,?)", (batchid, time.time()))
+            self._commit()
+        except Exception:
+            self.discard()
+            raise
+
+    def discard(self):
+        # drops everything queued or written since the last commit
+        self._batches = {}
+        try:
+            self.dbengine.connection.rollback()
+        except Exception as e:
+            logging.debug("SQLITEDB: Unable to roll back: {}".format(e))
 
     def _exists(self, tablename):
         cursor = self._getCursor()
@@ -85,6 +204,14 @@ class LogDB(object):
             return False
         return True
 
+    def check_version(self):
+        # for readers: only checks that brocess wrote this database in a version this one can read,
+        # without creating tables or expiring anything
+        if not self._exists("properties"):
+            logging.critical("Database has no properties table.  It has not been written by brocess.")
+            return False
+        return self._checkVersion()
+
     def instantiate(self):
         if not self._exists("properties"):
             self._create_properties()
@@ -93,12 +220,12 @@ class LogDB(object):
                 return False
         cursor = self._getCursor()
         cursor.execute(
-            "create table if not exists connlog (sourceip not null, destip not null, destport INTEGER not null, "
-            " numconnections INTEGER, firstconnectdate, PRIMARY KEY(sourceip,destip,destport))"
+            "create table if not exists connlog (sourceip BLOB not null, destip BLOB not null, "
+            "destport INTEGER not null, numconnections INTEGER, firstconnectdate, PRIMARY KEY(sourceip,destip,destport))"
         )
         cursor.execute(
-            "create table if not exists connerr (sourceip not null, destip not null, destport INTEGER not null, "
-            " numconnections INTEGER, firstconnectdate, PRIMARY KEY(sourceip,destip,destport))"
+            "create table if not exists connerr (sourceip BLOB not null, destip BLOB not null, "
+            "destport INTEGER not null, numconnections INTEGER, firstconnectdate, PRIMARY KEY(sourceip,destip,destport))"
         )
         cursor.execute(
             "create table if not exists smtplog (source not null, destination not null, numconnections integer, "
@@ -108,74 +235,147 @@ class LogDB(object):
             "create table if not exists httplog (host not null, numconnections integer, firstconnectdate, "
             "PRIMARY KEY(host))"
         )
+        cursor.execute(
+            "create table if not exists connlog_daily (day TEXT not null, sourceip BLOB not null, destip BLOB not null, "
+            "destport INTEGER not null, numconnections INTEGER, firstconnectdate, lastconnectdate, "
+            "PRIMARY KEY(day,sourceip,destip,destport))"
+        )
+        cursor.execute(
+            "create table if not exists connerr_daily (day TEXT not null, sourceip BLOB not null, destip BLOB not null, "
+            "destport INTEGER not null, numconnections INTEGER, firstconnectdate, lastconnectdate, "
+            "PRIMARY KEY(day,sourceip,destip,destport))"
+        )
+        cursor.execute(
+            "create table if not exists smtplog_daily (day TEXT not null, source not null, destination not null, "
+            "numconnections integer, firstconnectdate, lastconnectdate, PRIMARY KEY(day,source,destination))"
+        )
+        cursor.execute(
+            "create table if not exists httplog_daily (day TEXT not null, host not null, numconnections integer, "
+            "firstconnectdate, lastconnectdate, PRIMARY KEY(day,host))"
+        )
+        # the primary keys serve range queries by day, these serve the history of a single key
+        cursor.execute("create index if not exists connlog_daily_key on connlog_daily (sourceip,destip,destport)")
+        cursor.execute("create index if not exists connerr_daily_key on connerr_daily (sourceip,destip,destport)")
+        cursor.execute("create index if not exists smtplog_daily_key on smtplog_daily (source,destination)")
+        cursor.execute("create index if not exists httplog_daily_key on httplog_daily (host)")
+        cursor.execute("create table if not exists sketches (name TEXT not null, data BLOB, PRIMARY KEY(name))")
+        cursor.execute("insert or ignore into sketches (name) values ('cms:connlog'),('cms:connerr')")
+        cursor.execute(
+            "create table if not exists conn_sources (sourceip BLOB not null, registers BLOB, destinations INTEGER, "
+            "PRIMARY KEY(sourceip))"
+        )
+        cursor.execute(
+            "create table if not exists ingested_files (digest TEXT not null, path TEXT, size INTEGER, mtime REAL, "
+            "lineoffset INTEGER, complete INTEGER, updated REAL, PRIMARY KEY(digest))"
+        )
+        cursor.execute("create table if not exists applied_batches (batchid TEXT not null, applied REAL, "
+                       "PRIMARY KEY(batchid))")
+        cursor.execute("delete from applied_batches where applied < ?", (time.time() - self.applied_batch_age,))
         self._commit()
         return True
 
     def destruct(self):
         self.dbengine._destruct()
 
-    def add_conn_record(self, data):
+    def compact_rollups(self, before):
+        # drops the rollup rows of days before the given YYYY-MM-DD date.  the lifetime tables are updated in the
+        # same flush as the rollups, so they already count those days
         cursor = self._getCursor()
-        if data["conn_state"] == "SF":
-            cursor.execute(
-                "insert or ignore into connlog (sourceip,destip,destport,numconnections,firstconnectdate) "
-                "values (?,?,?,0,?)",
-                (data["id.orig_h"], data["id.resp_h"], data["id.resp_p"], data["ts"])
-            )
-            cursor.execute(
-                "update connlog set numconnections=numconnections+1 where "
-                "sourceip=? and destip=? and destport=?",
-                (data["id.orig_h"], data["id.resp_h"], data["id.resp_p"])
-            )
-        else:
-            cursor.execute(
-                "insert or ignore into connlog (sourceip,destip,destport,numconnections,firstconnectdate) "
-                "values (?,?,?,0,?)",
-                (data["id.orig_h"], data["id.resp_h"], data["id.resp_p"], data["ts"])
-            )
-            cursor.execute(
-                "update connlog set numconnections=numconnections+1 where "
-                "sourceip=? and destip=? and destport=?",
-                (data["id.orig_h"], data["id.resp_h"], data["id.resp_p"])
-            )
-
+        removed = 0
+        for table in self.rollup_tables:
+            cursor.execute("delete from " + table + " where day < ?", (before,))
+            removed += cursor.rowcount
         self._commit()
-        return
+        return removed
 
-    def add_smtp_record(self, data):
+    def get_ingested_file(self, digest):
+        # returns (lineoffset, complete) for a file recorded in the ingest ledger, or None
         cursor = self._getCursor()
-        cursor.execute("select count(*) from smtplog where source=? and destination=?",
-                       (data["source"], data["destination"]))
-        result = int(cursor.fetchone()[0])
-        if result == 0:
-            cursor.execute(
-                "insert into smtplog (source,destination,numconnections,firstconnectdate) "
-                "values (?,?,1,?)",
-                (data["mailfrom"], data["rcptto"], data["ts"])
-            )
+        cursor.execute("select lineoffset,complete from ingested_files where digest=?", (digest,))
+        return cursor.fetchone()
+
+    def record_ingested_file(self, entry):
+        # written in the same transaction as the rows it accounts for and committed by the next flush()
+        cursor = self._getCursor()
+        cursor.execute(
+            "insert into ingested_files (digest,path,size,mtime,lineoffset,complete,updated) "
+            "values (?,?,?,?,?,?,?) on conflict(digest) do update set path=excluded.path,"
+            "lineoffset=excluded.lineoffset,complete=excluded.complete,updated=excluded.updated",
+            (entry["digest"], entry["path"], entry["size"], entry["mtime"], entry["lineoffset"],
+             1 if entry["complete"] else 0, time.time())
+        )
+
+    def lookup(self, table, keys):
+        # returns {key: (numconnections, firstconnectdate)} for those of the given key tuples found in table,
+        # reading query_chunk_size keys per statement
+        columns = self.key_columns[table]
+        if len(columns) == 1:
+            match, template = columns[0] + " in (", "?"
         else:
-            cursor.execute(
-                "update smtplog set numconnections=numconnections+1 where source=? and destination=?",
-                (data["mailfrom"], data["rcptto"])
-            )
-        self._commit()
-        return
+            match, template = "(" + ",".join(columns) + ") in (values ", "(" + ",".join("?" for column in columns) + ")"
+        keys = list(keys)
+        results = {}
+        cursor = self._getCursor()
+        for i in range(0, len(keys), self.query_chunk_size):
+            chunk = keys[i:i + self.query_chunk_size]
+            cursor.execute("select " + ",".join(columns) + ",numconnections,firstconnectdate from " + table + " where " +
+                           match + ",".join(template for key in chunk) + ")", [value for key in chunk for value in key])
+            for row in cursor.fetchall():
+                results[tuple(row[:-2])] = (row[-2], row[-1])
+        return results
 
-    def add_http_record(self, data):
-        try:
-            cursor = self._getCursor()
-            cursor.execute(
-                "insert or ignore into httplog (host,numconnections,firstconnectdate) "
-                "values (?,?,?)",
-                (data["host"], 1, data["ts"])
-            )
-            cursor.execute(
-                "update httplog set numconnections=numconnections+1 where "
-                "host=?",
-                (data["host"], )
-            )
-            self._commit()
-            #cursor.close()
-        except:
-            logging.error("MYSQLDB: Error processing: " + repr(data))
-        return
+    def load_sketch(self, name):
+        # takes the write lock first, so concurrent writers fold their batches into the sketches one after another
+        if not self.dbengine.connection.in_transaction:
+            self.dbengine.connection.execute("begin immediate")
+        cursor = self._getCursor()
+        cursor.execute("select data from sketches where name=?", (name,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    def store_sketch(self, name, data):
+        cursor = self._getCursor()
+        cursor.execute("update sketches set data=? where name=?", (data, name))
+
+    def load_source_sketches(self, sourceips):
+        # returns {sourceip: registers} for the sources that have a distinct destination sketch
+        sourceips = sorted(sourceips)
+        results = {}
+        cursor = self._getCursor()
+        for i in range(0, len(sourceips), self.query_chunk_size):
+            chunk = sourceips[i:i + self.query_chunk_size]
+            cursor.execute("select sourceip,registers from conn_sources where sourceip in (" +
+                           ",".join("?" for sourceip in chunk) + ")", chunk)
+            for sourceip, registers in cursor.fetchall():
+                results[sourceip] = registers
+        return results
+
+    def store_source_sketches(self, sketches):
+        # {sourceip: (registers, estimated distinct destinations)}
+        rows = sorted((sourceip, registers, destinations) for sourceip, (registers, destinations) in sketches.items())
+        cursor = self._getCursor()
+        cursor.executemany("insert into conn_sources (sourceip,registers,destinations) values (?,?,?) "
+                           "on conflict(sourceip) do update set registers=excluded.registers,"
+                           "destinations=excluded.destinations", rows)
+
+    def add_conn_record(self, data, count=1):
+        table = "connlog" if data["conn_state"] == "SF" else "connerr"
+        self._queue(table, (data["id.orig_h"], data["id.resp_h"], data["id.resp_p"], count, data["ts"]))
+
+    def add_smtp_record(self, data, count=1):
+        self._queue("smtplog", (data["mailfrom"], data["rcptto"], count, data["ts"]))
+
+    def add_http_record(self, data, count=1):
+        self._queue("httplog", (data["host"], count, data["ts"]))
+
+    def add_conn_rollup(self, data, count=1):
+        table = "connlog_daily" if data["conn_state"] == "SF" else "connerr_daily"
+        self._queue(table, (data["day"], data["id.orig_h"], data["id.resp_h"], data["id.resp_p"], count, data["ts"],
+                            data["last_ts"]))
+
+    def add_smtp_rollup(self, data, count=1):
+        self._queue("smtplog_daily", (data["day"], data["mailfrom"], data["rcptto"], count, data["ts"],
+                                      data["last_ts"]))
+
+    def add_http_rollup(self, data, count=1):
+        self._queue("httplog_daily", (data["day"], data["host"], count, data["ts"], data["last_ts"]))
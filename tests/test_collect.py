@@ -0,0 +1,95 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collect import Collector, LocalSource, Manifest  # noqa: E402
+
+
+class FailingSource(LocalSource):
+    # writes part of each file before the transfer is cut off
+    def fetch(self, path, localpath):
+        with open(localpath, "wb") as f:
+            f.write(b"partial")
+        raise IOError("connection reset")
+
+
+class CollectTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="brocess-collect.")
+        self.sensor = os.path.join(self.tmp, "sensor")
+        self.destination = os.path.join(self.tmp, "data")
+        os.makedirs(self.destination)
+        self.manifest = Manifest(os.path.join(self.destination, "manifest.db"))
+        self.collector = Collector(self.manifest, self.destination, min_age=60)
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, data, age=3600):
+        # a file on the sensor last written age seconds ago
+        filepath = os.path.join(self.sensor, *path.split("/"))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "wb") as f:
+            f.write(data)
+        mtime = time.time() - age
+        os.utime(filepath, (mtime, mtime))
+
+    def collect(self, source=None):
+        source = source or LocalSource("s1", self.sensor)
+        return sorted(localpath for name, localpath in self.collector.collect([source]))
+
+    def local(self, path):
+        return os.path.join(self.destination, "s1", *path.split("/"))
+
+    def test_new_files_are_transferred_and_recorded(self):
+        self.write("2018-01-01/http.00:00:00-01:00:00.log.gz", b"http")
+        self.write("2018-01-01/smtp.00:00:00-01:00:00.log.gz", b"smtp!")
+        self.write("2018-01-01/conn.00:00:00-01:00:00.log.gz", b"conn")
+        self.write("current/http.log.gz", b"open")
+        self.write("2018-01-01/http.01:00:00-02:00:00.log.gz", b"fresh", age=0)
+
+        self.assertEqual(self.collect(), [self.local("2018-01-01/http.00:00:00-01:00:00.log.gz"),
+                                          self.local("2018-01-01/smtp.00:00:00-01:00:00.log.gz")])
+        with open(self.local("2018-01-01/smtp.00:00:00-01:00:00.log.gz"), "rb") as f:
+            self.assertEqual(f.read(), b"smtp!")
+        known = self.manifest.lookup("s1", ["2018-01-01/http.00:00:00-01:00:00.log.gz",
+                                            "2018-01-01/smtp.00:00:00-01:00:00.log.gz",
+                                            "2018-01-01/conn.00:00:00-01:00:00.log.gz"])
+        self.assertEqual(sorted(known), ["2018-01-01/http.00:00:00-01:00:00.log.gz",
+                                         "2018-01-01/smtp.00:00:00-01:00:00.log.gz"])
+        self.assertEqual(known["2018-01-01/smtp.00:00:00-01:00:00.log.gz"][0], 5)
+
+    def test_transferred_files_are_skipped(self):
+        self.write("2018-01-01/http.00:00:00-01:00:00.log.gz", b"http")
+        self.assertEqual(len(self.collect()), 1)
+        # removed locally once ingested, and still not pulled again
+        os.remove(self.local("2018-01-01/http.00:00:00-01:00:00.log.gz"))
+        self.assertEqual(self.collect(), [])
+
+    def test_changed_files_are_transferred_again(self):
+        self.write("2018-01-01/http.00:00:00-01:00:00.log.gz", b"http")
+        self.collect()
+        self.write("2018-01-01/http.00:00:00-01:00:00.log.gz", b"http, longer")
+        self.assertEqual(self.collect(), [self.local("2018-01-01/http.00:00:00-01:00:00.log.gz")])
+        with open(self.local("2018-01-01/http.00:00:00-01:00:00.log.gz"), "rb") as f:
+            self.assertEqual(f.read(), b"http, longer")
+
+    def test_failed_transfers_leave_no_partial_file(self):
+        self.write("2018-01-01/http.00:00:00-01:00:00.log.gz", b"http")
+        self.assertEqual(self.collect(FailingSource("s1", self.sensor)), [])
+        self.assertEqual(os.listdir(os.path.dirname(self.local("2018-01-01/http.00:00:00-01:00:00.log.gz"))), [])
+        self.assertEqual(self.manifest.lookup("s1", ["2018-01-01/http.00:00:00-01:00:00.log.gz"]), {})
+        # and it is pulled on the next run, to its final name
+        self.assertEqual(self.collect(), [self.local("2018-01-01/http.00:00:00-01:00:00.log.gz")])
+        self.assertEqual(os.listdir(os.path.dirname(self.local("2018-01-01/http.00:00:00-01:00:00.log.gz"))),
+                         ["http.00:00:00-01:00:00.log.gz"])
+
+
+if __name__ == "__main__":
+    unittest.main()
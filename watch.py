@@ -0,0 +1,138 @@
+import logging
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+def _walk_files(path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+class PollingWatcher(object):
+    # a file is considered finished once its size and mtime are unchanged between two scans
+    def __init__(self, paths, interval=5):
+        self.paths = paths
+        self.interval = interval
+        self.running = True
+        self._pending = {}
+        self._seen = set()
+
+    def stop(self):
+        self.running = False
+
+    def poll(self):
+        finished = []
+        pending = {}
+        existing = set()
+        for path in self.paths:
+            for filepath in _walk_files(path):
+                existing.add(filepath)
+                if filepath in self._seen:
+                    continue
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                state = (st.st_size, st.st_mtime)
+                if self._pending.get(filepath) == state:
+                    finished.append(filepath)
+                    self._seen.add(filepath)
+                else:
+                    pending[filepath] = state
+        self._pending = pending
+        # files that were removed (e.g. by -r) no longer need to be remembered
+        self._seen &= existing
+        return finished
+
+    def watch(self):
+        while self.running:
+            for filepath in self.poll():
+                yield filepath
+                if not self.running:
+                    return
+            time.sleep(self.interval)
+
+
+class InotifyWatcher(object):
+    # rsync writes to a temporary file and renames it into place, so a finished file shows up as either a
+    # close after writing or a move into a watched directory
+    def __init__(self, paths, interval=5):
+        self.paths = paths
+        self.interval = interval
+        self.running = True
+        self.inotify = inotify_simple.INotify()
+        self.file_mask = inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO
+        self.mask = self.file_mask | inotify_simple.flags.CREATE
+        self._watches = {}
+        # (size, mtime) of every file handed out, as a file found by a scan may show up again in an event
+        self._yielded = {}
+
+    def stop(self):
+        self.running = False
+
+    def _add_tree(self, path):
+        # watches a directory and everything below it, returning the files that are already there
+        found = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            try:
+                wd = self.inotify.add_watch(dirpath, self.mask)
+            except OSError as e:
+                logging.error("Unable to watch " + dirpath + ": " + str(e))
+                continue
+            self._watches[wd] = dirpath
+            found.extend(os.path.join(dirpath, filename) for filename in filenames)
+        return found
+
+    def _new(self, filepath):
+        # whether filepath has not been handed out yet, or has changed since
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return False
+        state = (st.st_size, st.st_mtime)
+        if self._yielded.get(filepath) == state:
+            return False
+        self._yielded[filepath] = state
+        return True
+
+    def watch(self):
+        waiting = []
+        for path in self.paths:
+            waiting.extend(self._add_tree(path))
+        for filepath in waiting:
+            if self._new(filepath):
+                yield filepath
+            if not self.running:
+                return
+        while self.running:
+            events = self.inotify.read(timeout=int(self.interval * 1000))
+            if not events:
+                # files that were removed (e.g. by -r) no longer need to be remembered
+                self._yielded = dict((filepath, state) for filepath, state in self._yielded.items()
+                                     if os.path.exists(filepath))
+            for event in events:
+                directory = self._watches.get(event.wd)
+                if directory is None or not event.name:
+                    continue
+                filepath = os.path.join(directory, event.name)
+                if event.mask & inotify_simple.flags.ISDIR:
+                    for found in self._add_tree(filepath):
+                        if self._new(found):
+                            yield found
+                elif event.mask & self.file_mask and self._new(filepath):
+                    yield filepath
+                if not self.running:
+                    return
+
+
+def create_watcher(paths, interval=5):
+    if inotify_simple:
+        return InotifyWatcher(paths, interval)
+    logging.info("inotify_simple is not installed, polling for new files every " + str(interval) + " seconds")
+    return PollingWatcher(paths, interval)
@@ -0,0 +1,158 @@
+import bisect
+import ipaddress
+import logging
+import socket
+
+
+def _merge_ranges(ranges):
+    # collapses overlapping and adjacent (start, end) ranges into sorted, disjoint start and end lists
+    starts = []
+    ends = []
+    for start, end in sorted(ranges):
+        if ends and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+            continue
+        starts.append(start)
+        ends.append(end)
+    return starts, ends
+
+
+def _in_ranges(ranges, value):
+    starts, ends = ranges
+    i = bisect.bisect_right(starts, value) - 1
+    return i >= 0 and value <= ends[i]
+
+
+def _address_value(address):
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big")
+    except OSError:
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, address), "big")
+    except OSError:
+        return None, None
+
+
+class AddressWhitelist(object):
+    # single IPv4/IPv6 addresses and CIDR blocks, e.g. 10.1.2.3, 10.0.0.0/8 or 2001:db8::/32
+    def __init__(self, entries):
+        self.exact = set()
+        ranges = {4: [], 6: []}
+        for entry in entries:
+            try:
+                network = ipaddress.ip_network(entry.strip(), strict=False)
+            except ValueError:
+                logging.error("Invalid address in whitelist: " + entry)
+                continue
+            if network.num_addresses == 1:
+                self.exact.add(entry.strip())
+                self.exact.add(str(network.network_address))
+            else:
+                ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+        self.ranges = dict((version, _merge_ranges(r)) for version, r in ranges.items() if r)
+
+    def __len__(self):
+        return len(self.exact) + sum(len(starts) for starts, ends in self.ranges.values())
+
+    def __contains__(self, address):
+        if address in self.exact:
+            return True
+        if not self.ranges:
+            return False
+        version, value = _address_value(address)
+        if version not in self.ranges:
+            return False
+        return _in_ranges(self.ranges[version], value)
+
+
+class PortWhitelist(object):
+    # single ports and inclusive ranges, e.g. 53 or 6881-6889
+    def __init__(self, entries):
+        self.exact = set()
+        ranges = []
+        for entry in entries:
+            entry = entry.strip()
+            try:
+                if "-" in entry:
+                    start, end = entry.split("-", 1)
+                    ranges.append((int(start), int(end)))
+                else:
+                    self.exact.add(str(int(entry)))
+            except ValueError:
+                logging.error("Invalid port in whitelist: " + entry)
+        self.ranges = _merge_ranges(ranges) if ranges else None
+
+    def __len__(self):
+        return len(self.exact) + (len(self.ranges[0]) if self.ranges else 0)
+
+    def __contains__(self, port):
+        if port in self.exact:
+            return True
+        if not self.ranges:
+            return False
+        try:
+            return _in_ranges(self.ranges, int(port))
+        except ValueError:
+            return False
+
+
+class SuffixWhitelist(object):
+    # email addresses and domains:
+    #   user@example.com   that address
+    #   @example.com       any address at example.com
+    #   *.example.com      any address at example.com or one of its subdomains (also written .example.com)
+    def __init__(self, entries):
+        self.exact = set()
+        self.domains = set()
+        self.suffixes = set()
+        for entry in entries:
+            entry = entry.strip().lower()
+            if entry.startswith("*."):
+                self.suffixes.add(entry[2:])
+            elif entry.startswith("."):
+                self.suffixes.add(entry[1:])
+            elif entry.startswith("*@"):
+                self.domains.add(entry[2:])
+            elif entry.startswith("@"):
+                self.domains.add(entry[1:])
+            else:
+                self.exact.add(entry)
+
+    def __len__(self):
+        return len(self.exact) + len(self.domains) + len(self.suffixes)
+
+    def __contains__(self, value):
+        if value in self.exact:
+            return True
+        domain = value.rsplit("@", 1)[-1]
+        if domain in self.domains:
+            return True
+        if not self.suffixes:
+            return False
+        while True:
+            if domain in self.suffixes:
+                return True
+            i = domain.find(".")
+            if i < 0:
+                return False
+            domain = domain[i + 1:]
+
+
+# the matcher used for each whitelist section of the ini file
+matchers = {
+    "conn_dest_whitelist_ips": AddressWhitelist,
+    "conn_src_whitelist_ips": AddressWhitelist,
+    "conn_sketch_watchlist": AddressWhitelist,
+    "conn_dest_whitelist_ports": PortWhitelist,
+    "smtp_whitelist_source": SuffixWhitelist,
+    "smtp_whitelist_destination": SuffixWhitelist,
+}
+
+
+def compile_whitelists(whitelists):
+    compiled = {}
+    for whitelist_type, entries in whitelists.items():
+        compiled[whitelist_type] = matchers[whitelist_type](entries)
+        logging.debug("compiled " + str(len(compiled[whitelist_type])) + " entries for " + whitelist_type)
+    return compiled
@@ -0,0 +1,58 @@
+import logging
+import queue
+import threading
+import traceback
+
+
+class AsyncWriter(object):
+    # drains batches of aggregated records to the database on its own thread so parsing can continue while the
+    # database round-trips.  the queue is bounded, so a parser that gets ahead of the database blocks in put().
+    # drop is called with every batch that is not written, to free what it holds
+    def __init__(self, write, maxsize=4, drop=None):
+        self.write = write
+        self.drop = drop
+        self.queue = queue.Queue(maxsize)
+        self.errors = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                # once a batch has failed later ones are dropped, so nothing is committed past the lost rows
+                if self.error is None:
+                    self.write(batch)
+                elif self.drop:
+                    self.drop(batch)
+            except Exception as e:
+                self.errors += 1
+                self.error = e
+                logging.error("Error writing batch: " + traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("writer thread failed: " + str(self.error))
+
+    def put(self, batch):
+        self._check()
+        self.queue.put(batch)
+
+    def join(self):
+        # waits until every batch handed over so far has been written
+        self.queue.join()
+        self._check()
+
+    def reset(self):
+        # waits for the batches handed over so far, which are dropped after a failure, and takes new ones again
+        self.queue.join()
+        self.error = None
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()